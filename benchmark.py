@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import multiprocessing
+from urllib.parse import parse_qs
+
+# offline benchmark: replays conversations through answer() of app.py against local fake openai and telegram bot api servers.
+# The fake servers run in their own process so that the cpu time measured here is the cpu time of the bot only.
+#
+#   python benchmark.py --users 10,50,100 --trace conversations.jsonl --tokens-per-second 50 --latency 0.5
+#
+# Reports per number of users the p50/p99 time to first edit (user message -> first edit with the answer),
+# total latency (user message -> answer finished), edits per answer, and users per core.
+
+
+def percentile(values, p):
+    # nearest rank percentile, p in [0, 100]
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+async def read_request(reader):
+    # minimal http/1.1 request parser, returns (method, path, headers, body) or None if the connection was closed
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    method, path = lines[0].split(" ")[:2]
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def write_json(writer, data, status="200 OK"):
+    body = json.dumps(data).encode()
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+
+class FakeOpenAI:
+    # streams answers of answer_tokens tokens at tokens_per_second after latency seconds,
+    # error_rate of the requests fail with 429 or 500 to exercise the retries
+    def __init__(self, tokens_per_second=50.0, latency=0.5, answer_tokens=150, error_rate=0.0):
+        self.tokens_per_second = tokens_per_second
+        self.latency = latency
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.words = itertools.cycle(["Lorem", "ipsum", "dolor", "sit", "amet,", "consectetur", "adipiscing", "elit", "sed", "do."])
+
+    def _chunk(self, model, content=None, finish_reason=None):
+        delta = {"content": content} if content is not None else {}
+        data = {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(data)}\n\n".encode()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                body = json.loads(request[3] or b"{}")
+                model = body.get("model", "gpt-3.5-turbo")
+                if random.random() < self.error_rate:
+                    if random.random() < 0.5:
+                        write_json(writer, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, "429 Too Many Requests")
+                    else:
+                        write_json(writer, {"error": {"message": "The server is overloaded", "type": "server_error"}}, "500 Internal Server Error")
+                    await writer.drain()
+                    continue
+                await asyncio.sleep(self.latency)
+                if not body.get("stream"):
+                    # tool calls and summaries
+                    message = {"role": "assistant", "content": " ".join(next(self.words) for _ in range(30))}
+                    write_json(writer, {"id": "bench", "object": "chat.completion", "created": int(time.time()), "model": model, "choices": [{"index": 0, "message": message, "finish_reason": "stop"}]})
+                    await writer.drain()
+                    continue
+                # chunked transfer encoding so the connection can be kept alive
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                start = time.monotonic()
+                for i in range(self.answer_tokens):
+                    data = self._chunk(model, next(self.words) + " ")
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain()
+                    # tokens are sent at a steady rate, independent of the time the writes took
+                    await asyncio.sleep(max(0.0, start + (i + 1) / self.tokens_per_second - time.monotonic()))
+                data = self._chunk(model, finish_reason="stop") + b"data: [DONE]\n\n"
+                writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(data), data))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class FakeTelegram:
+    # answers the bot api methods used by app.py after latency seconds, and records when messages were sent and edited.
+    # GET /events returns the records: chat id -> [[method, time], ...]
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.events = {}
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id", 0))
+        message_id = int(params["message_id"]) if "message_id" in params else next(self.message_ids)
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if path == "/events":
+                    write_json(writer, self.events)
+                    await writer.drain()
+                    break
+                if headers.get("content-type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                api_method = path.rsplit("/", 1)[-1]
+                await asyncio.sleep(self.latency)
+                if api_method == "getMe":
+                    result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+                elif api_method in ("sendMessage", "editMessageText"):
+                    result = self._message(params)
+                    self.events.setdefault(params.get("chat_id"), []).append([api_method, time.time()])
+                else:
+                    result = True
+                write_json(writer, {"ok": True, "result": result})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def run_servers(openai_port, telegram_port, options):
+    # entry point of the server process
+    async def run():
+        openai_server = FakeOpenAI(options["tokens_per_second"], options["latency"], options["answer_tokens"], options["error_rate"])
+        telegram_server = FakeTelegram(options["telegram_latency"])
+        servers = [
+            await asyncio.start_server(openai_server.handle, "127.0.0.1", openai_port),
+            await asyncio.start_server(telegram_server.handle, "127.0.0.1", telegram_port),
+        ]
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    asyncio.run(run())
+
+
+async def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def get_events(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /events HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+def load_conversations(path):
+    # one conversation per line: {"messages": [...]}, or a request of requests.jsonl ({"title": ..., "body": ...}), or {"text": ...}
+    conversations = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if "messages" in data:
+                conversations.append(data["messages"])
+            elif "title" in data:
+                conversations.append([data["title"], data["body"]] if data.get("body") else [data["title"]])
+            else:
+                conversations.append([data["text"]])
+    return conversations
+
+
+def synthetic_conversations(length=3):
+    messages = ["What is the difference between a process and a thread?", "Can you give me an example in Python?", "How do I make it faster?"]
+    return [messages[:length]]
+
+
+def make_update(update_id, user_id, message_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def replay(app, application, user_ids, conversations, think_time):
+    # every user sends the messages of one conversation, waiting for each answer and think_time seconds before the next one.
+    # returns [(user_id, start, end)] of every message
+    from telegram import Update
+
+    update_ids = itertools.count(1)
+    results = []
+
+    async def user(user_id, messages):
+        # users do not all start at the same moment
+        await asyncio.sleep(random.uniform(0, think_time))
+        for message_id, text in enumerate(messages, 1):
+            update = Update.de_json(make_update(next(update_ids), user_id, message_id, text), application.bot)
+            start = time.time()
+            await application.process_update(update)
+            results.append((user_id, start, time.time()))
+            await asyncio.sleep(random.uniform(0.5, 1.5) * think_time)
+
+    await asyncio.gather(*(user(user_id, conversations[i % len(conversations)]) for i, user_id in enumerate(user_ids)))
+    return results
+
+
+def summarize(results, events):
+    first_edit = []
+    total = []
+    edits = []
+    for user_id, start, end in results:
+        times = [t for method, t in events.get(str(user_id), []) if method == "editMessageText" and start <= t <= end]
+        total.append(end - start)
+        edits.append(len(times))
+        if times:
+            first_edit.append(times[0] - start)
+    return first_edit, total, edits
+
+
+async def run_benchmark(args):
+    openai_port, telegram_port = args.port, args.port + 1
+    options = {
+        "tokens_per_second": args.tokens_per_second,
+        "latency": args.latency,
+        "answer_tokens": args.answer_tokens,
+        "error_rate": args.error_rate,
+        "telegram_latency": args.telegram_latency,
+    }
+    context = multiprocessing.get_context("spawn")
+    servers = context.Process(target=run_servers, args=(openai_port, telegram_port, options), daemon=True)
+    servers.start()
+    await wait_for_port(openai_port)
+    await wait_for_port(telegram_port)
+
+    # app.py creates its openai clients when imported, point them at the fake server first
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_port}/v1"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    from cache import ResponseCache
+    from rate_limiter import RateLimiter
+
+    # the fake server has no budget, measure the bot instead of the rate limiter
+    app.chatgpt.rate_limiter = RateLimiter({model: {"rpm": 10**6, "tpm": 10**9} for model in (app.chatgpt.fast_and_cheap_model, app.chatgpt.advanced_model)}, {"burst": 100, "rpm": 6000})
+    app.chatgpt.router.rate_limiter = app.chatgpt.rate_limiter
+    # users send the same messages, answers from the cache would not measure anything
+    app.chatgpt.cache = ResponseCache(first_turn=args.cache)
+    application = app.build_application(base_url=f"http://127.0.0.1:{telegram_port}/bot")
+    await application.initialize()
+
+    conversations = load_conversations(args.trace) if args.trace else synthetic_conversations()
+    print(f"{len(conversations)} conversations, {args.tokens_per_second} tokens/s, {args.answer_tokens} tokens per answer, openai latency {args.latency} s, telegram latency {args.telegram_latency} s")
+    print(f"{'users':>6} {'first edit p50':>15} {'p99':>7} {'total p50':>10} {'p99':>7} {'edits':>6} {'cpu':>6} {'users/core':>11}")
+    next_user = itertools.count(1)
+    for n_users in args.users:
+        user_ids = [next(next_user) for _ in range(n_users)]
+        app.settings.whitelist = frozenset(user_ids)
+        wall, cpu = time.monotonic(), time.process_time()
+        results = await replay(app, application, user_ids, conversations, args.think_time)
+        wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+        first_edit, total, edits = summarize(results, await get_events(telegram_port))
+        # cores used by the bot while all users were active, users per core assumes cpu is the limit
+        cores = cpu / wall
+        print(
+            f"{n_users:>6} {percentile(first_edit, 50):>14.2f}s {percentile(first_edit, 99):>6.2f}s {percentile(total, 50):>9.2f}s {percentile(total, 99):>6.2f}s "
+            f"{sum(edits) / len(edits):>6.1f} {cores:>5.0%} {n_users / cores if cores else float('inf'):>11.0f}"
+        )
+        if len(first_edit) < len(results):
+            print(f"       {len(results) - len(first_edit)} of {len(results)} answers were never edited")
+
+    await application.shutdown()
+    servers.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local fake openai and telegram servers")
+    parser.add_argument("--users", type=lambda s: [int(n) for n in s.split(",")], default=[1, 10, 50], help="comma separated numbers of concurrent users, e.g. 10,50,100")
+    parser.add_argument("--trace", default=None, help="jsonl file of conversations, one {\"messages\": [...]} per line, default: a synthetic conversation")
+    parser.add_argument("--think-time", type=float, default=2.0, help="average seconds between an answer and the next message of the same user")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="speed of the fake openai answers")
+    parser.add_argument("--answer-tokens", type=int, default=150, help="length of the fake openai answers")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the first token of the fake openai answers")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of openai requests that fail with 429 or 500")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per fake telegram request")
+    parser.add_argument("--cache", action="store_true", help="cache answers to first messages (first_turn of the response cache)")
+    parser.add_argument("--port", type=int, default=18080, help="port of the fake openai server, the fake telegram server uses the next one")
+    asyncio.run(run_benchmark(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
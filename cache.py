@@ -0,0 +1,88 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def normalize(text):
+    # requests that only differ in white space around the message get the same answer,
+    # white space inside is kept, e.g. code that only differs in indentation is a different request
+    return text.strip()
+
+
+def make_key(model, messages, temperature, extra=None):
+    data = {
+        "model": model,
+        "messages": [[m["role"], normalize(m["content"])] for m in messages],
+        "temperature": temperature,
+        "extra": extra,
+    }
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    # LRU cache of openai answers with a time to live, optionally also kept in a SQLite file.
+    # first_turn: also cache answers to the first message of a conversation, not only deterministic requests.
+    # Off by default, the answer is shared by all users who send the same first message in the same mode.
+    # get_prompt uses it from threads, everything is done under the lock
+    def __init__(self, max_entries=1000, ttl=24 * 3600, path=None, first_turn=False):
+        self.max_entries = max_entries
+        self.first_turn = first_turn
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.lock = threading.Lock()
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, created REAL, value TEXT)")
+            self.db.commit()
+
+    def get(self, key):
+        # the cached value, or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT created, value FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+                    self._remember(key, entry)
+            if entry is None or entry[0] < time.time() - self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        # None means a miss for get, so it is not cached
+        if value is None:
+            return
+        entry = (time.time(), value)
+        with self.lock:
+            self._remember(key, entry)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO cache (key, created, value) VALUES (?, ?, ?)", (key, entry[0], json.dumps(value, ensure_ascii=False)))
+                self.db.execute("DELETE FROM cache WHERE created < ?", (entry[0] - self.ttl,))
+                self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "entries": len(self.entries)}
+
+
+def create_cache(config=None):
+    # build the cache from the "response_cache" part of config.json
+    config = dict(config or {})
+    if "ttl_hours" in config:
+        config["ttl"] = config.pop("ttl_hours") * 3600
+    return ResponseCache(**config)
@@ -0,0 +1,93 @@
+import time
+from tokens import count_tokens, encoding_name, tokens_per_message, tokens_per_reply
+
+
+class Message:
+    __slots__ = ("role", "content", "tokens", "tokens_encoding")
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+        # number of tokens of content for tokens_encoding, counted once when first needed
+        self.tokens = None
+        self.tokens_encoding = None
+
+    def count_tokens(self, model):
+        encoding = encoding_name(model)
+        if self.tokens is None or self.tokens_encoding != encoding:
+            self.tokens = count_tokens(self.content, model)
+            self.tokens_encoding = encoding
+        return self.tokens
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+class PromptTable:
+    # system prompts shared by many users (the mode prompts) are stored once, together with their number of tokens.
+    # Other prompts (custom mode, SYSTEMPROMPT:) belong to one conversation and go away with it
+    def __init__(self):
+        # prompt -> Message
+        self.shared = {}
+
+    def share(self, shared_prompts):
+        # replace the shared prompts, e.g. when the modes are reloaded, conversations keep the prompt they have
+        self.shared = {prompt: self.shared.get(prompt) or Message("system", prompt) for prompt in shared_prompts}
+
+    def get(self, prompt):
+        # the shared message of prompt, or a new one for this conversation only
+        message = self.shared.get(prompt)
+        return message if message is not None else Message("system", prompt)
+
+
+prompts = PromptTable()
+
+
+class Conversation:
+    # everything the bot remembers about one user, messages do not include the system prompt
+    __slots__ = ("prompt", "messages", "last_time", "use_GPT4", "summary", "model")
+
+    def __init__(self, prompt=None, messages=None, last_time=None, use_GPT4=False, summary=None, model=None):
+        # system message from prompts.get, None until the first system prompt is set
+        self.prompt = prompt
+        self.messages = messages if messages is not None else []
+        self.last_time = last_time if last_time is not None else time.time()
+        self.use_GPT4 = use_GPT4
+        self.summary = summary
+        # model that gave the last answer, chosen by router.py
+        self.model = model
+
+    @property
+    def system_prompt(self):
+        return self.prompt.content
+
+    def to_payload(self):
+        # messages in the format of the openai api, only built when sending a request
+        payload = [self.prompt.to_dict()]
+        if self.summary is not None:
+            payload.append({"role": "system", "content": "Summary of the earlier conversation: " + self.summary})
+        payload.extend(m.to_dict() for m in self.messages)
+        return payload
+
+    def count_tokens(self, model):
+        # tokens of to_payload(), same as tokens.count_message_tokens but with the counts kept on the messages
+        total = self.prompt.count_tokens(model) + tokens_per_message + tokens_per_reply
+        if self.summary is not None:
+            total += count_tokens("Summary of the earlier conversation: " + self.summary, model) + tokens_per_message
+        return total + sum(m.count_tokens(model) + tokens_per_message for m in self.messages)
+
+    def to_dict(self):
+        return {
+            "system_prompt": self.system_prompt if self.prompt is not None else None,
+            "messages": [[m.role, m.content] for m in self.messages],
+            "last_time": self.last_time,
+            "use_GPT4": self.use_GPT4,
+            "summary": self.summary,
+            "model": self.model,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        prompt = prompts.get(data["system_prompt"]) if data["system_prompt"] is not None else None
+        messages = [Message(role, content) for role, content in data["messages"]]
+        return cls(prompt, messages, data["last_time"], data["use_GPT4"], data["summary"], data.get("model"))
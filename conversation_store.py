@@ -0,0 +1,220 @@
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from conversation import Conversation, Message, prompts
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore:
+    # in-memory LRU store: at most max_users conversations, conversations inactive for ttl seconds are removed,
+    # and at most max_messages messages are kept per conversation
+    def __init__(self, max_users=10000, ttl=24 * 3600, max_messages=100):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.conversations = OrderedDict()
+
+    def _expired(self, conversation, now=None):
+        return conversation.last_time < (now or time.time()) - self.ttl
+
+    def _load(self, user_id):
+        # conversations that are not in memory, overridden by persistent stores
+        return None
+
+    def get(self, user_id):
+        # return the conversation of user_id, or None if there is none or it has expired
+        conversation = self.conversations.get(user_id)
+        if conversation is None:
+            conversation = self._load(user_id)
+            if conversation is None:
+                return None
+            self._cache(user_id, conversation)
+        else:
+            self.conversations.move_to_end(user_id)
+        if self._expired(conversation):
+            self.delete(user_id)
+            return None
+        return conversation
+
+    def save(self, user_id, conversation):
+        # call after every change of a conversation
+        conversation.last_time = time.time()
+        if len(conversation.messages) > self.max_messages:
+            conversation.messages = conversation.messages[-self.max_messages :]
+        self._cache(user_id, conversation)
+
+    def _cache(self, user_id, conversation):
+        self.conversations[user_id] = conversation
+        self.conversations.move_to_end(user_id)
+        while len(self.conversations) > self.max_users:
+            self.conversations.popitem(last=False)
+
+    def delete(self, user_id):
+        self.conversations.pop(user_id, None)
+
+    def evict_expired(self):
+        now = time.time()
+        expired = [user_id for user_id, conversation in self.conversations.items() if self._expired(conversation, now)]
+        for user_id in expired:
+            self.delete(user_id)
+        return len(expired)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    async def run(self, interval=600):
+        # background maintenance, remove expired conversations instead of waiting for the user to come back
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_expired()
+
+    def __len__(self):
+        return len(self.conversations)
+
+
+class SQLiteConversationStore(ConversationStore):
+    # conversations survive restarts, the in-memory LRU is used as a cache and changes are written in batches
+    def __init__(self, path="conversations.db", max_users=10000, ttl=24 * 3600, max_messages=100, batch_size=100):
+        super().__init__(max_users, ttl, max_messages)
+        self.batch_size = batch_size
+        # conversations changed since the last flush, kept here even if they leave the LRU cache
+        self.dirty = {}
+        self.deleted = set()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS conversations (user_id TEXT PRIMARY KEY, last_time REAL, data TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS conversations_last_time ON conversations (last_time)")
+        self.db.commit()
+
+    def _load(self, user_id):
+        with self.lock:
+            if user_id in self.dirty:
+                return self.dirty[user_id]
+            if user_id in self.deleted:
+                return None
+            row = self.db.execute("SELECT data FROM conversations WHERE user_id = ?", (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        return Conversation.from_dict(json.loads(row[0]))
+
+    def save(self, user_id, conversation):
+        super().save(user_id, conversation)
+        with self.lock:
+            self.dirty[user_id] = conversation
+            self.deleted.discard(user_id)
+            full = len(self.dirty) >= self.batch_size
+        if full:
+            self.flush()
+
+    def delete(self, user_id):
+        super().delete(user_id)
+        with self.lock:
+            self.dirty.pop(user_id, None)
+            self.deleted.add(user_id)
+
+    def evict_expired(self):
+        count = super().evict_expired()
+        self._delete_expired_rows()
+        return count
+
+    def _delete_expired_rows(self):
+        # only touches the database, safe to run in a thread
+        with self.lock:
+            self.db.execute("DELETE FROM conversations WHERE last_time < ?", (time.time() - self.ttl,))
+            self.db.commit()
+
+    def flush(self):
+        # write all changes in one transaction
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            deleted, self.deleted = self.deleted, set()
+            try:
+                rows = [(str(user_id), c.last_time, json.dumps(c.to_dict(), ensure_ascii=False)) for user_id, c in dirty.items()]
+                self.db.executemany("INSERT OR REPLACE INTO conversations (user_id, last_time, data) VALUES (?, ?, ?)", rows)
+                self.db.executemany("DELETE FROM conversations WHERE user_id = ?", [(str(user_id),) for user_id in deleted])
+                self.db.commit()
+            except Exception:
+                # keep the changes for the next flush, the lock is held so nothing changed in between
+                self.db.rollback()
+                self.dirty, self.deleted = dirty, deleted
+                raise
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    async def run(self, interval=600, flush_interval=5):
+        # write changes every flush_interval seconds in a thread so the event loop is not blocked
+        loop = asyncio.get_running_loop()
+        last_eviction = time.monotonic()
+        while True:
+            await asyncio.sleep(flush_interval)
+            try:
+                await loop.run_in_executor(None, self.flush)
+                if time.monotonic() - last_eviction > interval:
+                    last_eviction = time.monotonic()
+                    # the LRU is only changed on the event loop, get and save use it at the same time
+                    super().evict_expired()
+                    await loop.run_in_executor(None, self._delete_expired_rows)
+            except Exception as e:
+                # keep writing changes, a failed flush is written again with the next one
+                logger.error("Conversation store maintenance failed: {}".format(e))
+
+
+def create_store(config=None):
+    # build the store from the "conversation_store" part of config.json
+    config = dict(config or {})
+    backend = config.pop("backend", "memory")
+    if "ttl_hours" in config:
+        config["ttl"] = config.pop("ttl_hours") * 3600
+    if backend == "sqlite":
+        return SQLiteConversationStore(**config)
+    if backend == "memory":
+        return ConversationStore(**config)
+    raise ValueError(f"Unknown conversation store backend: {backend}")
+
+
+if __name__ == "__main__":
+    # benchmark memory and latency with many simulated users
+    import os
+    import random
+    import tempfile
+    import tracemalloc
+
+    n_users = 100000
+    # sqlite keeps only a tenth of the users in memory, so most gets are read from disk
+    cached_users = {"memory": n_users, "sqlite": n_users // 10}
+    prompts.share(["You are a helpful assistant."])
+    for name in ("memory", "sqlite"):
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        config = {"backend": name, "max_users": cached_users[name]}
+        store = create_store({**config, "path": path} if name == "sqlite" else config)
+        tracemalloc.start()
+        start = time.perf_counter()
+        for user_id in range(n_users):
+            # system prompts are built per user like the modes in app.py, but the shared ones are only stored once
+            prompt = prompts.get(" ".join(("You are", "a helpful assistant.")))
+            # a distinct string per message, so the memory includes the text of every message
+            question = f"Hello, how are you? I am user {user_id}. " * 3
+            answer = f"I'm fine, thank you user {user_id}! How can I help? " * 3
+            store.save(user_id, Conversation(prompt, [Message("user", question), Message("assistant", answer)]))
+        store.flush()
+        save_time = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for _ in range(n_users):
+            store.get(random.randrange(n_users))
+        get_time = time.perf_counter() - start
+        print(f"{name}: {n_users} users, {cached_users[name]} in memory, {memory / n_users:.0f} bytes per user, save {save_time / n_users * 1e6:.1f} us, get {get_time / n_users * 1e6:.1f} us")
+        store.close()
@@ -0,0 +1,304 @@
+import re
+
+# local pre-filter for generative mode: decide without any network request whether a message could be a request
+# to generate an image or a video. Only these candidates are sent to get_prompt (an openai tool call request),
+# all other messages go straight to the chat.
+# A missed request means the user gets a text answer instead of an image, an extra candidate only costs the
+# request that was made for every message before, so the bias is chosen for a recall of at least 90%.
+
+# weights of terms, found by hand on the first labeled set in __main__ and kept small so they are easy to adjust.
+# The bias is chosen on the separate validation set in __main__: bare descriptions without a request word
+# ("an astronaut riding a horse") score only the bias, so they are candidates unless the message has words of
+# a question ("what", "explain", ...). On the held-out set in __main__ recall is 100% and about three quarters
+# of the messages still call get_prompt, mostly chat messages without such words ("good morning!").
+# ascii terms match whole words, other terms (chinese, japanese) match anywhere in the message
+term_weights = {
+    # asking for content
+    "draw": 3.0, "paint": 3.0, "sketch": 2.5, "render": 2.0, "illustrate": 2.5, "generate": 1.5, "create": 1.0,
+    "make": 0.5, "show me": 1.0, "design": 1.0, "animate": 3.0,
+    "画": 2.0, "描": 2.0, "生成": 2.0, "作成": 1.5, "作って": 1.5, "做": 0.5, "来一张": 3.0, "来个": 1.0, "作画": 3.0,
+    # kind of content
+    "image": 2.0, "images": 2.0, "picture": 2.0, "pictures": 2.0, "photo": 1.5, "photos": 1.5, "drawing": 2.0,
+    "painting": 1.5, "illustration": 2.0, "portrait": 1.5, "wallpaper": 2.0, "logo": 1.5, "icon": 1.0,
+    "video": 2.0, "videos": 2.0, "animation": 2.0, "clip": 1.0, "gif": 2.0, "artwork": 2.0, "poster": 1.5,
+    "图": 1.5, "图片": 2.0, "照片": 1.5, "视频": 2.0, "动画": 2.0, "画像": 2.0, "写真": 1.5, "動画": 2.0, "絵": 2.0,
+    "イラスト": 2.0, "アニメ": 1.0,
+    # style words that mostly appear in image prompts
+    "oil painting": 2.0, "watercolor": 2.0, "in the style of": 2.0, "cartoon": 1.0, "anime": 1.0,
+    "photorealistic": 2.5, "4k": 1.5, "8k": 1.5, "cyberpunk": 1.0, "风格": 1.0, "風": 0.5,
+    # asking about something rather than for something
+    "what": -1.5, "why": -2.0, "how": -1.5, "explain": -2.5, "difference": -2.0, "code": -2.0, "function": -2.0,
+    "python": -2.0, "error": -2.0, "translate": -2.0, "summarize": -2.5, "meaning": -2.0, "mean": -1.0,
+    "history": -1.0, "who": -1.0, "when": -1.0, "write": -1.5, "essay": -2.0, "email": -2.0, "list": -1.0,
+    "recommend": -1.0, "compare": -1.5, "algorithm": -2.0, "regex": -2.0, "sql": -2.0,
+    "什么": -1.5, "为什么": -2.0, "怎么": -1.5, "如何": -1.5, "解释": -2.5, "翻译": -2.0, "代码": -2.0,
+    "なぜ": -2.0, "どう": -1.5, "何": -1.0, "説明": -2.5, "翻訳": -2.0, "コード": -2.0,
+}
+# chosen on the validation set: the lowest bias (fewest candidates) with recall at least 90%, see __main__
+bias = 0.0
+# messages with a score at least this high are candidates
+threshold = 0.0
+
+# commands and phrasings that are always candidates
+_direct = re.compile(r"^\s*/(draw|image|img|video|imagine)\b|^\s*(draw|paint|sketch|imagine)\s+(me\s+)?(a|an|the|some|my)\b", re.IGNORECASE)
+
+
+def _build_pattern(terms):
+    parts = []
+    # longer terms first so "oil painting" is found instead of "painting"
+    for term in sorted(terms, key=len, reverse=True):
+        if term.isascii():
+            parts.append(r"\b" + re.escape(term) + r"\b")
+        else:
+            parts.append(re.escape(term))
+    return re.compile("|".join(parts))
+
+
+_terms = _build_pattern(term_weights)
+
+
+def score(message):
+    # higher means more likely a request to generate content, each term is counted once
+    return bias + sum(term_weights[term] for term in set(_terms.findall(message.lower())))
+
+
+def is_generation_candidate(message):
+    # True if the message should be checked with get_prompt
+    if _direct.search(message):
+        return True
+    return score(message) >= threshold
+
+
+if __name__ == "__main__":
+    # benchmark routing accuracy and latency on labeled messages.
+    # get_prompt is not called here, its latency is an assumption that can be passed as argument (in seconds)
+    import sys
+    import time
+
+    get_prompt_latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.8
+    generate = [
+        "draw a cat sitting on the moon",
+        "Draw me a picture of a sunset over the ocean",
+        "can you paint a castle in the style of Van Gogh",
+        "generate an image of a futuristic city, cyberpunk, 8k",
+        "I want a video of a dog running on the beach",
+        "make a short animation of falling leaves",
+        "create a logo for my coffee shop",
+        "a portrait of an old fisherman, oil painting",
+        "show me a picture of a dragon",
+        "/draw mountains at dawn",
+        "/video waves crashing on rocks",
+        "photorealistic image of a red sports car",
+        "watercolor painting of a small village",
+        "sketch a robot playing guitar",
+        "illustrate a children's book page with a bear",
+        "anime style wallpaper of a girl under cherry blossoms",
+        "could you make me a gif of a spinning globe",
+        "design a poster for a jazz concert",
+        "画一只猫",
+        "生成一张海边日落的图片",
+        "来一张赛博朋克风格的城市图",
+        "帮我做一个小狗跑步的视频",
+        "猫の絵を描いて",
+        "富士山の画像を生成して",
+        "桜の動画を作って",
+        "イラストを描いてください、ドラゴン",
+        "imagine a forest made of glass",
+        "render a 3d model of a spaceship",
+        "picture of a bowl of ramen, 4k",
+        "paint me a stormy sea",
+    ]
+    chat = [
+        "what is the capital of France?",
+        "How do I reverse a list in python?",
+        "explain the difference between TCP and UDP",
+        "why is the sky blue?",
+        "write an email to my boss asking for a day off",
+        "translate this to Japanese: good morning",
+        "summarize the history of the Roman empire",
+        "what does 'ephemeral' mean?",
+        "recommend some books about machine learning",
+        "fix this error: TypeError: 'NoneType' object is not subscriptable",
+        "who won the world cup in 2018?",
+        "write a function that checks if a number is prime",
+        "compare React and Vue",
+        "hello!",
+        "thanks, that helped a lot",
+        "tell me a joke",
+        "how do I draw a histogram with matplotlib?",
+        "what is the best camera for taking photos at night?",
+        "explain how image compression works",
+        "what algorithm does video streaming use?",
+        "can you make the previous answer shorter?",
+        "list five healthy breakfast ideas",
+        "what's the weather usually like in Tokyo in April",
+        "write a regex that matches email addresses",
+        "什么是机器学习？",
+        "为什么天空是蓝色的",
+        "这段代码怎么优化",
+        "東京でおすすめのラーメン屋は？",
+        "この文章を英語に翻訳して",
+        "なぜ猫は箱が好きなの？",
+        "give me a workout plan for beginners",
+        "I feel tired today",
+        "SQL query to count rows per user",
+        "what is the meaning of life",
+        "how many calories are in an apple",
+    ]
+    # written after the weights were chosen, only used to choose the bias
+    validation_generate = [
+        "a lighthouse on a cliff during a storm",
+        "can you make a picture of my dog as an astronaut",
+        "a bowl of fruit, still life",
+        "generate a video of clouds moving over mountains",
+        "draw a cute owl reading a book",
+        "I want an image of a medieval market",
+        "a neon sign that says open, night street",
+        "paint a field of sunflowers",
+        "a cozy coffee shop interior, warm lighting",
+        "make a cartoon of a cat chef",
+        "a samurai standing in the rain, cinematic",
+        "create a banner with autumn leaves",
+        "an underwater city with glowing fish",
+        "show me a castle made of candy",
+        "a futuristic train in the desert",
+        "画一个在雨中的女孩",
+        "生成一张雪山的照片",
+        "给我一个熊猫吃竹子的动画",
+        "夕焼けの海の絵を描いて",
+        "ロボットの画像を作成して",
+        "a logo with a fox and a moon",
+        "sketch of a hummingbird",
+        "an old map of an imaginary island",
+        "a teddy bear on a swing, soft colors",
+        "short clip of a candle flickering",
+    ]
+    validation_chat = [
+        "what is the difference between RAM and storage",
+        "how do I center a div in css",
+        "give me a recipe for pancakes",
+        "why do leaves change color in autumn",
+        "tell me a fun fact about octopuses",
+        "what's a good book for learning statistics",
+        "write a cover letter for a data analyst job",
+        "how long does it take to learn guitar",
+        "explain recursion like I'm five",
+        "who painted the starry night",
+        "is coffee bad for you",
+        "translate 'thank you' into German",
+        "what are the rules of chess",
+        "how do I take better photos with my phone",
+        "can you check my grammar: I goes to school",
+        "what is photosynthesis",
+        "你好，今天过得怎么样",
+        "为什么猫喜欢睡觉",
+        "日本の首都はどこですか",
+        "このエラーの意味を教えて",
+        "suggest a name for my startup",
+        "how many planets are in the solar system",
+        "what video games are popular right now",
+        "ok thanks",
+        "help me plan a birthday party",
+    ]
+    # written after the weights were chosen and not used to change them or the bias, so this is the accuracy to expect
+    held_out_generate = [
+        "photo of a cat",
+        "a cat wearing sunglasses on a skateboard",
+        "can I get an image of the eiffel tower at night",
+        "I need a banner for my youtube channel",
+        "make me a meme with a confused dog",
+        "a dragon flying over a volcano, digital art",
+        "give me a cute sticker of a panda",
+        "could you draw my cat as a knight",
+        "turn this into a picture: a quiet lake at sunrise",
+        "I'd like a short video of fireworks over a city",
+        "pixel art of a tiny spaceship",
+        "paint a portrait of a woman in renaissance style",
+        "create an illustration for a fantasy novel cover",
+        "show me what a cyberpunk tokyo street would look like",
+        "generate a clip of rain falling on a window",
+        "a minimalist logo of a mountain and a sun",
+        "帮我画一幅山水画",
+        "给我生成一个猫咪跳舞的视频",
+        "海の写真みたいな画像を作って",
+        "夜景のイラストが欲しい",
+        "draw a map of a fantasy kingdom",
+        "an astronaut riding a horse on mars",
+        "make a wallpaper with purple galaxies",
+        "sketch of a vintage car",
+        "3d render of a cozy cabin in the snow",
+    ]
+    held_out_chat = [
+        "what is a good name for my cat?",
+        "how do photos get stored on a phone",
+        "can you describe the mona lisa",
+        "explain what stable diffusion is",
+        "I love painting, any tips for beginners?",
+        "what's the best video editing software",
+        "how much does a professional photographer charge",
+        "tell me about Van Gogh's life",
+        "write a poem about the sea",
+        "how do I resize an image in python",
+        "why do cats purr",
+        "plan a 3 day trip to Kyoto",
+        "what time is it in London",
+        "convert 5 miles to km",
+        "is it going to rain tomorrow",
+        "help me debug this javascript",
+        "what should I cook tonight",
+        "这幅画是谁画的？",
+        "明日の天気は？",
+        "怎么学习画画",
+        "recommend a camera under 500 dollars",
+        "summarize this article for me",
+        "who directed the movie Inception",
+        "what is the capital of Australia",
+        "good morning!",
+    ]
+
+    def evaluate(name, generate, chat):
+        messages = [(m, True) for m in generate] + [(m, False) for m in chat]
+        rounds = 1000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            predictions = [is_generation_candidate(m) for m, _ in messages]
+        classify_time = (time.perf_counter() - start) / rounds / len(messages)
+
+        true_positive = sum(p and label for p, (_, label) in zip(predictions, messages))
+        false_positive = sum(p and not label for p, (_, label) in zip(predictions, messages))
+        false_negative = sum(not p and label for p, (_, label) in zip(predictions, messages))
+        accuracy = sum(p == label for p, (_, label) in zip(predictions, messages)) / len(messages)
+        print(f"{name}:")
+        for p, (m, label) in zip(predictions, messages):
+            if p != label:
+                print(f"  {'missed' if label else 'extra'}: {m} (score {score(m):.1f})")
+
+        # before, every message waited for get_prompt, now only candidates do
+        candidates = true_positive + false_positive
+        saved = (len(messages) - candidates) * get_prompt_latency / len(messages)
+        print(f"  {len(messages)} messages, accuracy {accuracy:.1%}, recall {true_positive / (true_positive + false_negative):.1%}, "
+              f"precision {true_positive / max(candidates, 1):.1%}")
+        print(f"  classification {classify_time * 1e6:.1f} us per message, {candidates} of {len(messages)} messages call get_prompt")
+        print(f"  latency saved {saved * 1000:.0f} ms per message on average (get_prompt {get_prompt_latency * 1000:.0f} ms)")
+
+    def choose_bias(generate, chat, min_recall=0.9):
+        # the lowest bias (fewest get_prompt calls) with recall at least min_recall
+        global bias
+        current = bias
+        chosen = None
+        for step in range(-12, 5):
+            bias = step / 2
+            recall = sum(is_generation_candidate(m) for m in generate) / len(generate)
+            candidates = sum(is_generation_candidate(m) for m in generate + chat)
+            print(f"  bias {bias:5.1f}: recall {recall:.1%}, {candidates} of {len(generate) + len(chat)} messages call get_prompt")
+            if chosen is None and recall >= min_recall:
+                chosen = bias
+        bias = current
+        print(f"  chosen bias {chosen}, used bias {bias}")
+
+    print("validation set:")
+    choose_bias(validation_generate, validation_chat)
+    # the weights were chosen by hand on the first set, its numbers are optimistic
+    evaluate("tuning set (weights chosen on it)", generate, chat)
+    evaluate("validation set (bias chosen on it)", validation_generate, validation_chat)
+    evaluate("held-out set", held_out_generate, held_out_chat)
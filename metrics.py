@@ -0,0 +1,222 @@
+import time
+import random
+import asyncio
+import logging
+import bisect
+import queue
+import logging.handlers
+
+# metrics of the bot in the prometheus text format, served by serve() on http://host:port/metrics.
+# Enable with the optional "metrics" part of config.json, e.g. "metrics": {"port": 9100, "trace": 0.01, "log_sample_rate": 0.1}
+# Every process has its own metrics, webhook.py gives each worker its own port.
+
+# seconds
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values -> value
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        # function() returns the current value, or a dict of label values -> value, when the metrics are read
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def render(self):
+        if self.function is not None:
+            value = self.function()
+            self.values = value if isinstance(value, dict) else {(): value}
+        return super().render()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            # one count per bucket, then +Inf, sum
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, counts in sorted(self.values.items()):
+            total = 0
+            for bucket, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                lines.append(f"{self.name}_bucket{self._format_labels(key, ('le', str(bucket)))} {total}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# openai
+first_token_seconds = registry.add(Histogram("chatgpt_first_token_seconds", "Time from the user message to the first token of the answer", ["model"]))
+completion_seconds = registry.add(Histogram("chatgpt_completion_seconds", "Time from the user message to the end of the answer", ["model"]))
+tokens_per_second = registry.add(
+    Histogram("chatgpt_tokens_per_second", "Completion tokens per second after the first token", ["model"], buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200))
+)
+tokens = registry.add(Counter("chatgpt_tokens_total", "Prompt and completion tokens sent to and received from openai", ["model", "type"]))
+answers = registry.add(Counter("chatgpt_answers_total", "Answers by result", ["model", "result"]))
+retries = registry.add(Counter("chatgpt_retries_total", "Retried openai requests by error", ["error"]))
+failovers = registry.add(Counter("chatgpt_failovers_total", "Answers continued with another model after an error", ["source", "target"]))
+rate_limit_seconds = registry.add(Histogram("chatgpt_rate_limit_wait_seconds", "Time waiting for the openai rate limit budget"))
+# telegram
+edit_seconds = registry.add(Histogram("telegram_edit_seconds", "Latency of editMessageText requests"))
+edits = registry.add(Counter("telegram_edits_total", "Messages edited by result", ["result"]))
+first_edit_seconds = registry.add(Histogram("telegram_first_edit_seconds", "Time from the placeholder message to the first edit with the answer"))
+edits_per_answer = registry.add(Histogram("telegram_edits_per_answer", "Number of edits of one answer", buckets=(1, 2, 5, 10, 20, 50, 100)))
+# queue
+queue_wait_seconds = registry.add(Histogram("user_queue_wait_seconds", "Time a message waited for the previous messages of the same user"))
+
+
+def add_gauge(name, help, function, labels=()):
+    # value computed when the metrics are read, e.g. pool utilization or the cache hit rate
+    return registry.add(Gauge(name, help, labels, function))
+
+
+class Trace:
+    # optional profile of one request: time of every step since the trace was started
+    def __init__(self, name, enabled):
+        self.name = name
+        self.enabled = enabled
+        self.start = time.monotonic()
+        self.steps = []
+
+    def mark(self, step):
+        if self.enabled:
+            self.steps.append((step, time.monotonic() - self.start))
+
+    def finish(self, logger):
+        if self.enabled:
+            self.mark("end")
+            logger.info(f"Trace {self.name}: " + ", ".join(f"{step} {seconds * 1000:.1f} ms" for step, seconds in self.steps))
+
+
+# fraction of requests that are traced, and of requests whose message and answer are logged in full
+trace_rate = 0.0
+log_sample_rate = 1.0
+
+
+def start_trace(name):
+    return Trace(name, random.random() < trace_rate)
+
+
+def log_body(text, sampled):
+    # the text if this request is sampled, else only its length
+    return text if sampled else f"({len(text)} characters)"
+
+
+def sample():
+    return random.random() < log_sample_rate
+
+
+def configure(config=None):
+    global trace_rate, log_sample_rate
+    config = config or {}
+    trace_rate = float(config.get("trace", 0.0))
+    log_sample_rate = float(config.get("log_sample_rate", 1.0))
+
+
+def log_in_background(logger, others=()):
+    # move the handlers of logger to a thread so that writing log files does not block the event loop,
+    # the loggers in others (e.g. of openai_utils) are written by the same handlers.
+    # returns the listener, stop it at shutdown to write the remaining records
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *logger.handlers, respect_handler_level=True)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    queue_handler = logging.handlers.QueueHandler(records)
+    logger.addHandler(queue_handler)
+    for other in others:
+        other.setLevel(logger.level)
+        other.addHandler(queue_handler)
+        # only through the queue, not also through the handlers of the root logger
+        other.propagate = False
+    listener.start()
+    return listener
+
+
+async def serve(host="127.0.0.1", port=9100):
+    # minimal http server for prometheus, only GET /metrics
+    async def handle(reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            method, path = head.decode("latin-1").split(" ")[:2]
+            if method == "GET" and path.split("?")[0] == "/metrics":
+                body = registry.render().encode()
+                status = "200 OK"
+            else:
+                body = b""
+                status = "404 Not Found"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
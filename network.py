@@ -0,0 +1,204 @@
+import time
+import logging
+import httpx
+from telegram.request import HTTPXRequest
+
+# written in a thread by app.py, see metrics.log_in_background
+logger = logging.getLogger(__name__)
+
+# connection pools of the openai and telegram clients, configured with the optional "network" part of config.json, e.g.
+# "network": {"concurrency": 100, "openai": {"http2": true, "timeouts": {"chat": {"read": 20}}}, "telegram": {"read_timeout": 10}}
+# Both clients are created once and shared by all users, so connections are kept alive and reused between answers.
+
+# h2 is optional, without it http2 is not used
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+# number of answers expected to run at the same time, the pools are sized from it unless set explicitly
+default_concurrency = 100
+
+# timeouts of openai requests in seconds, per type of call.
+# for streaming answers, read is the longest wait between two chunks
+default_openai_timeouts = {
+    "chat": {"connect": 5.0, "read": 20.0, "write": 10.0, "pool": 10.0},
+    "tool": {"connect": 5.0, "read": 10.0, "write": 10.0, "pool": 5.0},
+    "summary": {"connect": 5.0, "read": 30.0, "write": 10.0, "pool": 30.0},
+}
+
+
+class PoolStats:
+    # requests in flight on a connection pool, to see if the pool is too small for the load.
+    # in_flight includes requests waiting for a free connection, a utilization above 1 means requests are queued
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.pool_timeouts = 0
+        self.errors = 0
+        # seconds until the response headers arrived, includes waiting for a free connection
+        self.total_wait = 0.0
+
+    def start(self):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return time.monotonic()
+
+    def headers(self, start):
+        self.total_wait += time.monotonic() - start
+
+    def end(self, error=None):
+        self.in_flight -= 1
+        # telegram wraps httpx.PoolTimeout in its own TimedOut error
+        if isinstance(error, httpx.PoolTimeout) or "pool timeout" in str(error).lower():
+            self.pool_timeouts += 1
+        elif error is not None:
+            self.errors += 1
+
+    def get_stats(self):
+        return {
+            "max_connections": self.max_connections,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "utilization": self.in_flight / self.max_connections if self.max_connections else 0.0,
+            "requests": self.requests,
+            "pool_timeouts": self.pool_timeouts,
+            "errors": self.errors,
+            "average_wait": self.total_wait / self.requests if self.requests else 0.0,
+        }
+
+
+class _CountedStream(httpx.AsyncByteStream):
+    # a streaming answer keeps its connection until the body is closed
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+        self.closed = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.stats.end()
+        await self.stream.aclose()
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    # httpx transport that records PoolStats of the wrapped transport
+    def __init__(self, transport, stats):
+        self.transport = transport
+        self.stats = stats
+
+    async def handle_async_request(self, request):
+        start = self.stats.start()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception as e:
+            self.stats.end(e)
+            raise
+        except BaseException:
+            self.stats.end()
+            raise
+        self.stats.headers(start)
+        response.stream = _CountedStream(response.stream, self.stats)
+        return response
+
+    def open_connections(self):
+        # httpx does not expose its connection pool, this is only used for stats
+        pool = getattr(self.transport, "_pool", None)
+        return len(pool.connections) if pool is not None else None
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class CountingHTTPXRequest(HTTPXRequest):
+    # telegram request that records PoolStats, every call of the bot api goes through do_request
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def do_request(self, *args, **kwargs):
+        start = self.stats.start()
+        try:
+            result = await super().do_request(*args, **kwargs)
+        except Exception as e:
+            self.stats.end(e)
+            raise
+        except BaseException:
+            self.stats.end()
+            raise
+        self.stats.headers(start)
+        self.stats.end()
+        return result
+
+
+class Network:
+    def __init__(self, config=None):
+        config = config or {}
+        concurrency = config.get("concurrency", default_concurrency)
+        self.openai_config = config.get("openai", {})
+        self.telegram_config = config.get("telegram", {})
+
+        self.openai_limits = httpx.Limits(
+            max_connections=self.openai_config.get("max_connections", concurrency),
+            max_keepalive_connections=self.openai_config.get("max_keepalive_connections", concurrency),
+            keepalive_expiry=self.openai_config.get("keepalive_expiry", 60.0),
+        )
+        self.openai_http2 = self.openai_config.get("http2", False)
+        if self.openai_http2 and h2 is None:
+            logger.warning("http2 is enabled in config.json but h2 is not installed, using http/1.1")
+            self.openai_http2 = False
+        self.openai_timeouts = {}
+        for name, timeout in default_openai_timeouts.items():
+            timeout = {**timeout, **self.openai_config.get("timeouts", {}).get(name, {})}
+            self.openai_timeouts[name] = httpx.Timeout(**timeout)
+
+        self.openai_stats = PoolStats(self.openai_limits.max_connections)
+        # every answer sends edits while it streams, new messages and chat actions need a few more connections
+        self.telegram_stats = PoolStats(self.telegram_config.get("connection_pool_size", concurrency + 8))
+        self.openai_transport = None
+
+    def openai_timeout(self, call):
+        # timeout for one type of call: "chat", "tool" or "summary"
+        return self.openai_timeouts[call]
+
+    def openai_client(self):
+        # http client for AsyncOpenAI, shared by all users
+        transport = httpx.AsyncHTTPTransport(limits=self.openai_limits, http2=self.openai_http2)
+        self.openai_transport = CountingTransport(transport, self.openai_stats)
+        return httpx.AsyncClient(transport=self.openai_transport, timeout=self.openai_timeouts["chat"], follow_redirects=True)
+
+    def openai_sync_client(self):
+        # http client for the blocking OpenAI client, used in threads
+        return httpx.Client(limits=self.openai_limits, http2=self.openai_http2, timeout=self.openai_timeouts["tool"], follow_redirects=True)
+
+    def _telegram_kwargs(self):
+        config = self.telegram_config
+        return {
+            "connect_timeout": config.get("connect_timeout", 5.0),
+            "read_timeout": config.get("read_timeout", 10.0),
+            "write_timeout": config.get("write_timeout", 10.0),
+            "pool_timeout": config.get("pool_timeout", 5.0),
+            "http_version": config.get("http_version", "1.1"),
+        }
+
+    def telegram_request(self):
+        # request for ApplicationBuilder.request(), used for all bot api calls except getUpdates
+        return CountingHTTPXRequest(self.telegram_stats, connection_pool_size=self.telegram_stats.max_connections, **self._telegram_kwargs())
+
+    def telegram_get_updates_request(self):
+        # getUpdates is a long poll that always holds one connection, it gets its own pool and is not counted
+        return HTTPXRequest(connection_pool_size=1, **self._telegram_kwargs())
+
+    def get_stats(self):
+        openai_stats = self.openai_stats.get_stats()
+        if self.openai_transport is not None:
+            openai_stats["open_connections"] = self.openai_transport.open_connections()
+        return {"openai": openai_stats, "telegram": self.telegram_stats.get_stats()}
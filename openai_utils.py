@@ -1,15 +1,29 @@
 import os
-import time
 import json
-import datetime
-from openai import OpenAI
+import time
+import asyncio
+import logging
+from openai import OpenAI, AsyncOpenAI
 from openai.types.chat import ChatCompletionToolParam
+from rate_limiter import RateLimiter
+from retry import RetryPolicy, ContextLengthExceeded, call_with_retry, call_with_retry_sync, stream_with_retry, classify_error
+from conversation import Conversation, Message, prompts
+from conversation_store import ConversationStore
+from cache import ResponseCache, make_key
+from network import Network
+from router import FailOver, create_router
+import metrics
+from settings import default_modes
+from tokens import context_windows, default_context_window, tokens_per_message, tokens_per_reply, count_tokens, count_message_tokens, fit_messages
+
+# written in a thread by the handlers of app.py, see metrics.log_in_background
+logger = logging.getLogger(__name__)
 
 # pauses symbols
 pauses = ".!?;:。！？；："
 
-# default prompt
-default_prompt = "You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible using the same language to the user"
+# prompt to fold old messages into the summary
+summary_prompt = "You maintain a short summary of a conversation between a user and an assistant. Update the current summary with the new messages. Keep names, facts, decisions and open questions, drop small talk. Answer with the updated summary only, in the language of the conversation, no longer than 200 words."
 
 tools = [
     # function to generate content
@@ -38,8 +52,16 @@ tools = [
 ]
 
 class ChatGPT:
-    def __init__(self, api_key=None):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key=None, rate_limits=None, context_budget=None, store=None, cache=None, network=None, router=None):
+        # connection pools and timeouts of the http clients, see network.py
+        self.network = network if network is not None else Network()
+        # retries are handled by retry.py, so that errors are classified the same way everywhere
+        self.client = OpenAI(api_key=api_key, max_retries=0, http_client=self.network.openai_sync_client())
+        # async client, used by the bot so that one streaming answer does not block other users
+        self.async_client = AsyncOpenAI(api_key=api_key, max_retries=0, http_client=self.network.openai_client())
+        self.retry_policy = RetryPolicy()
+        # the tool call delays the answer, give up sooner
+        self.tool_retry_policy = RetryPolicy(max_retry=1, timeout=20)
         # fast and cheap model
         self.fast_and_cheap_model = "gpt-3.5-turbo"
         self.advanced_model = "gpt-4-turbo"
@@ -48,14 +70,29 @@ class ChatGPT:
         # self.max_tokens = 1024
         # self.temperature = 0.7
 
-        # initialize messages
-        self.messages = {}
-        self.last_time = {}
-        self.use_GPT4 = {}
-        # use GPT-3.5-turbo by default, use GPT-4 if user sends /gpt4
+        # prompt of new chats, app.py sets the prompt of the start mode from config.json at start and on every reload
+        self.default_prompt = default_modes["start"]["prompt"]
 
-        # record last time of sending request to openai, prevent too frequent requests
-        self.last_time_request = {"time": datetime.datetime.now(), "user_id": None}
+        # conversations of all users: messages, last time, selected model and summary
+        # conversations inactive for 24 hours are removed by the store
+        self.store = store if store is not None else ConversationStore()
+        # answers of deterministic requests and of repeated first messages
+        self.cache = cache if cache is not None else ResponseCache()
+        # summary of old messages that were removed from the conversation, updated in the background
+        self.summary_tasks = {}
+        # summarize when the history is longer than summary_threshold tokens, keep the newest summary_keep tokens as they are
+        self.summary_threshold = 3000
+        self.summary_keep = 1000
+
+        # per user and per model rate limits, requests wait in a queue instead of blocking the whole bot
+        rate_limits = rate_limits or {}
+        self.rate_limiter = RateLimiter(rate_limits.get("models"), rate_limits.get("users"), rate_limits.get("max_wait", 60), rate_limits.get("shared_path"))
+        # model of each answer: tier chosen by the user, health and rate budget of the models, monthly token budgets
+        self.router = create_router(router, self.rate_limiter)
+        # number of tokens reserved for the answer
+        self.reply_tokens = 1024
+        # maximum number of tokens sent to each model, old messages are dropped before sending, defaults to the context window
+        self.context_budget = context_budget or {}
 
     # create prompts
     def _create_user_prompt(self, user_input):
@@ -68,131 +105,362 @@ class ChatGPT:
         return {"role": "system", "content": system_input}
 
     def reset_chat(self, user_id, system_prompt=None):
+        conversation = self.store.get(user_id)
         if system_prompt is None:
-            if user_id not in self.messages or len(self.messages[user_id]) == 0:
-                system_prompt = default_prompt
+            if conversation is None or conversation.prompt is None:
+                system_prompt = self.default_prompt
             else:
                 # keep current system prompt
-                system_prompt = self.messages[user_id][0]["content"]
+                system_prompt = conversation.system_prompt
 
-        # reset chat
-        self.messages[user_id] = []
-        self.last_time[user_id] = datetime.datetime.now()
-        self.messages[user_id].append(self._create_system_prompt(system_prompt))
+        # reset chat, but keep the selected model
+        use_GPT4 = conversation.use_GPT4 if conversation is not None else False
+        conversation = Conversation(prompts.get(system_prompt), use_GPT4=use_GPT4)
+        self.store.save(user_id, conversation)
+        return conversation
 
     def reduce_messeges(self, user_id, e):
-        if len(self.messages[user_id]) > 3:
+        conversation = self.store.get(user_id)
+        if conversation is not None and len(conversation.messages) > 2:
             # remove half of the messages
-            remove_length = (len(self.messages[user_id]) - 1) // 2
-            self.messages[user_id] = self.messages[user_id][:1] + self.messages[user_id][1 + remove_length :]
+            remove_length = len(conversation.messages) // 2
+            conversation.messages = conversation.messages[remove_length:]
+            self.store.save(user_id, conversation)
             message = "User: " + str(user_id) + " Forget first two messages to reduce length"
             return False, message
         else:
-            raise Exception(error)
+            raise e
+
+    def _create_payload(self, conversation):
+        # messages sent to openai: system prompt, summary of old messages if any, then the history
+        return conversation.to_payload()
+
+    def schedule_summary(self, user_id):
+        # fold old messages into the summary in the background, call it after the answer has been sent
+        conversation = self.store.get(user_id)
+        if user_id in self.summary_tasks or conversation is None:
+            return
+        model = self.fast_and_cheap_model
+        if sum(m.count_tokens(model) + tokens_per_message for m in conversation.messages) <= self.summary_threshold:
+            return
+        task = asyncio.create_task(self._summarize(user_id, conversation))
+        self.summary_tasks[user_id] = task
+        task.add_done_callback(lambda _: self.summary_tasks.pop(user_id, None))
+
+    async def _summarize(self, user_id, conversation):
+        model = self.fast_and_cheap_model
+        messages = conversation.messages
+        prompt = conversation.prompt
+        # keep the newest messages, fold everything before them
+        kept = 0
+        split = len(messages)
+        while split > 0 and kept + messages[split - 1].count_tokens(model) <= self.summary_keep:
+            split -= 1
+            kept += messages[split].count_tokens(model)
+        # do not separate an answer from its question
+        while split < len(messages) and messages[split].role == "assistant":
+            split += 1
+        # the last question and its answer are always kept, even if they alone are longer than summary_keep
+        last_question = max((i for i, m in enumerate(messages) if m.role == "user"), default=len(messages))
+        split = min(split, last_question)
+        folded = messages[:split]
+        if len(folded) == 0:
+            return
+
+        # only send the new messages together with the current summary, not the whole history
+        history = "\n".join("{}: {}".format(m.role, m.content) for m in folded)
+        request = [
+            self._create_system_prompt(summary_prompt),
+            self._create_user_prompt("Current summary: {}\n\nNew messages:\n{}".format(conversation.summary or "(empty)", history)),
+        ]
+        try:
+            await self.rate_limiter.acquire(user_id, model, self._estimate_tokens(request, model))
+            response = await call_with_retry(
+                lambda: self.async_client.chat.completions.create(
+                    model=model, messages=request, temperature=0.0, max_tokens=512, timeout=self.network.openai_timeout("summary")
+                ),
+                self.retry_policy,
+            )
+        except Exception as e:
+            logger.warning("User: {} Summary failed: {}".format(user_id, e))
+            return
+
+        # the chat may have been reset or trimmed while waiting for the summary
+        if self.store.get(user_id) is not conversation or conversation.prompt is not prompt:
+            return
+        folded_ids = set(id(m) for m in folded)
+        conversation.messages = [m for m in conversation.messages if id(m) not in folded_ids]
+        conversation.summary = response.choices[0].message.content
+        self.store.save(user_id, conversation)
+        logger.info("User: {} Fold {} messages into the summary".format(user_id, len(folded)))
+
+    def _save_if_current(self, user_id, conversation):
+        # do not bring back a conversation that was reset while waiting for openai
+        if self.store.get(user_id) is conversation:
+            self.store.save(user_id, conversation)
+
+    def _drop_unanswered(self, user_id, conversation):
+        # remove the last user message if it did not get an answer, so it is not sent twice next time
+        if len(conversation.messages) > 0 and conversation.messages[-1].role == "user":
+            conversation.messages.pop()
+            self._save_if_current(user_id, conversation)
 
     def switch_api(self, user_id):
-        self.last_time[user_id] = datetime.datetime.now()
-        # if not set, set to True, else switch
-        if user_id not in self.use_GPT4:
-            self.use_GPT4[user_id] = True
-        else:
-            self.use_GPT4[user_id] = not self.use_GPT4[user_id]
-        return "GPT-4" if self.use_GPT4[user_id] else "gpt-3.5-turbo-16k"
-
-    def check_overload(self, user_id):
-        # !TODO find a better way to handle this, currently the reason cause this is unknown
-        # check last_time_request, prevent too frequent requests within 2 seconds
-        if datetime.datetime.now() - self.last_time_request["time"] < datetime.timedelta(seconds=2):
-            # if not the same user, wait for 2 seconds
-            if self.last_time_request["user_id"] != user_id:
-                time.sleep(2)
-                self.last_time_request["time"] = datetime.datetime.now()
-                self.last_time_request["user_id"] = user_id
-            # if the same user, ingore this request
-            else:
-                raise Exception("TOOFREQUNET: too frequent requests")
-        else:
-            self.last_time_request["time"] = datetime.datetime.now()
-            self.last_time_request["user_id"] = user_id
+        conversation = self.store.get(user_id)
+        if conversation is None:
+            # no messages yet, the chat is started with the default prompt on the first message
+            conversation = Conversation()
+        # use GPT-3.5-turbo by default, switch between the two models
+        conversation.use_GPT4 = not conversation.use_GPT4
+        self.store.save(user_id, conversation)
+        return "GPT-4" if conversation.use_GPT4 else "gpt-3.5-turbo-16k"
+
+    def answered_by(self, user_id):
+        # model that gave the last answer to user_id, None before the first answer
+        conversation = self.store.get(user_id)
+        return conversation.model if conversation is not None else None
+
+    def _estimate_tokens(self, messages, model):
+        return count_message_tokens(messages, model) + self.reply_tokens
 
-    def get_prompt(self, user_message):
-        response = self.client.chat.completions.create(
+    def _fit_context(self, user_id, conversation, model):
+        # drop old messages before sending instead of waiting for openai to complain about the length
+        budget = self.context_budget.get(model, context_windows.get(model, default_context_window))
+        budget = min(budget, context_windows.get(model, default_context_window))
+        # leave room for the answer, the system prompt and the summary
+        budget -= self.reply_tokens + conversation.prompt.count_tokens(model) + tokens_per_message + tokens_per_reply
+        if conversation.summary is not None:
+            budget -= count_tokens(conversation.summary, model) + tokens_per_message
+        length = len(conversation.messages)
+        conversation.messages = fit_messages(conversation.messages, model, budget)
+        if len(conversation.messages) < length:
+            logger.info("User: {} Forget {} messages to fit in {} tokens".format(user_id, length - len(conversation.messages), budget))
+
+    def _create_tool_request(self, user_message):
+        return dict(
             model=self.fast_and_cheap_model,
             temperature=0.0,
-            messages = [self._create_user_prompt(user_message[1:])],
+            messages=[self._create_user_prompt(user_message[1:])],
             tools=tools,
             tool_choice="auto",  # auto is default, but we'll be explicit
         )
+
+    def _parse_tool_response(self, response):
         if response.choices[0].finish_reason == "tool_calls":
-            print("Tools were used to complete the prompt.")
+            logger.info("Tools were used to complete the prompt.")
             tool_calls = response.choices[0].message.tool_calls
             for tool_call in tool_calls:
                 if tool_call.type == "function":
                     function_arguments = tool_call.function.arguments
-                    print(f"function_arguments: {function_arguments}")
+                    logger.info(f"function_arguments: {function_arguments}")
                     return eval(function_arguments)
         else:
-            print("No tools were used to complete the prompt.")
+            logger.info("No tools were used to complete the prompt.")
             return response.choices[0].message.content
 
-    # chat function
-    def chat(self, user_id, user_message):
-        # decide response interval from 20 to 50.
-        interval = max(20, min(len(user_message) // 5, 50))
+    def _tool_request_key(self, request):
+        return make_key(request["model"], request["messages"], request["temperature"], [tool["function"]["name"] for tool in request["tools"]])
+
+    # blocking, called in a thread by the generative model. The http timeout ends each attempt, a thread cannot be cancelled
+    def get_prompt(self, user_message, on_retry=None):
+        request = self._create_tool_request(user_message)
+        # temperature is 0, the same message always gets the same result
+        key = self._tool_request_key(request)
+        result = self.cache.get(key)
+        if result is None:
+            response = call_with_retry_sync(
+                lambda: self.client.chat.completions.create(**request, timeout=self.network.openai_timeout("tool")), self.tool_retry_policy, on_retry
+            )
+            result = self._parse_tool_response(response)
+            self.cache.put(key, result)
+        return result
 
-        # if user_id not in self.messages or over 24 hours, reset chat
-        if (user_id not in self.messages) or (
-            user_id in self.last_time and self.last_time[user_id] < datetime.datetime.now() - datetime.timedelta(hours=24)
-        ):
+    def _prepare_chat(self, user_id, user_message):
+        # if there is no conversation or it is over 24 hours (removed by the store), reset chat
+        conversation = self.store.get(user_id)
+        if conversation is None or conversation.prompt is None:
             pre_answer = "Welcome to ChatGPT! You are in Default Chat Mode\n\n"
-            self.reset_chat(user_id, default_prompt)
+            conversation = self.reset_chat(user_id, self.default_prompt)
         else:
             pre_answer = ""
 
         # send user_message to chatgpt
-        self.messages[user_id].append(self._create_user_prompt(user_message))
-        # default to use gpt-3.5-turbo
-        if user_id not in self.use_GPT4:
-            self.use_GPT4[user_id] = False
-        # unless set to use gpt-4
-        if self.use_GPT4.get(user_id, True):
-            model = self.advanced_model
-        else:
-            model = self.fast_and_cheap_model
-        print("Current message: {}".format(str(self.messages[user_id])))
-        # !TODO make temperature adjustable to different users.
-        completion = self.client.chat.completions.create(model=model, stream=True, messages=self.messages[user_id], temperature=0.7)
-        status = ""
-        answer = pre_answer + ""
-        last_answer = ""
+        conversation.messages.append(Message("user", user_message))
+        # default to the fast tier, unless set to use gpt-4, the router picks the model of the tier
+        tier = "advanced" if conversation.use_GPT4 else "fast"
+        route = self.router.route(user_id, tier, conversation.count_tokens(self.fast_and_cheap_model) + self.reply_tokens)
+        self._fit_context(user_id, conversation, route.model)
+        self.store.save(user_id, conversation)
+        return conversation, route, pre_answer
 
-        for c in completion:
-            try:
-                delta = c.choices[0].delta
-                if delta.content != "" and delta.content is not None:
-                    status = "streaming"
-                    answer += delta.content
-                    # only return whole code block
-                    if answer.count("```") != 0:
-                        continue
+    def _process_chunk(self, user_id, conversation, c, state):
+        # update the streaming state with one chunk, return (status, answer) if it should be sent, else None
+        try:
+            delta = c.choices[0].delta
+            if delta.content != "" and delta.content is not None:
+                state["status"] = "streaming"
+                state["answer"] += delta.content
+                answer = state["answer"]
+                # without coalescing every delta is returned, the caller decides when to send it
+                if state["coalesce"]:
+                    # only return whole code block, a fence can be split over two deltas
+                    if state["code"] or "```" in answer[-len(delta.content) - 2 :]:
+                        state["code"] = True
+                        return None
                     # set interval to avoid too many requests, and if match the pauses symbol, send the message
-                    if len(answer) - len(last_answer) > interval and answer[-1] in pauses:
-                        last_answer = answer
+                    if len(answer) - len(state["last_answer"]) > state["interval"] and answer[-1] in pauses:
+                        state["last_answer"] = answer
                     else:
-                        continue
-                elif delta.content is None and c.choices[0].finish_reason == "stop":
-                    status = "finished"
-                    self.messages[user_id].append(self._create_chatgpt_answer(answer))
-                    self.last_time[user_id] = datetime.datetime.now()
-                else:
-                    # skip
-                    continue
-                # print(status, answer, len(answer))
-                yield status, answer
+                        return None
+            elif delta.content is None and c.choices[0].finish_reason == "stop":
+                state["status"] = "finished"
+                conversation.messages.append(Message("assistant", state["answer"]))
+                self._save_if_current(user_id, conversation)
+            else:
+                # skip
+                return None
+            # print(status, answer, len(answer))
+            return state["status"], state["answer"]
+
+        except Exception as e:
+            raise ValueError("Unexpected ChatGPT response: {} {}".format(c, e))
+
+    # chat function
+    def chat(self, user_id, user_message):
+        # decide response interval from 20 to 50.
+        interval = max(20, min(len(user_message) // 5, 50))
+        conversation, route, pre_answer = self._prepare_chat(user_id, user_message)
+        # !TODO make temperature adjustable to different users.
+        completion = self.client.chat.completions.create(model=route.model, stream=True, messages=self._create_payload(conversation), temperature=0.7)
+        state = {"status": "", "answer": pre_answer, "last_answer": "", "interval": interval, "coalesce": True, "code": False}
+
+        for c in completion:
+            result = self._process_chunk(user_id, conversation, c, state)
+            if result is not None:
+                yield result
+
+    def _first_turn_key(self, conversation, model, temperature):
+        # only the first message of a conversation is cached, later answers depend on the whole history
+        if not self.cache.first_turn or len(conversation.messages) != 1 or conversation.summary is not None:
+            return None
+        return make_key(model, self._create_payload(conversation), temperature)
+
+    async def _replay(self, user_id, conversation, state, cached_answer, chunk_size=20):
+        # stream a cached answer like an openai answer, so it goes through the same rendering
+        for i in range(0, len(cached_answer), chunk_size):
+            state["answer"] += cached_answer[i : i + chunk_size]
+            yield "streaming", state["answer"]
+            await asyncio.sleep(0)
+        conversation.messages.append(Message("assistant", state["answer"]))
+        self._save_if_current(user_id, conversation)
+        yield "finished", state["answer"]
+
+    def _record_answer(self, model, start, first_token, prompt_tokens, answer):
+        # metrics of one finished answer, see metrics.py, returns the number of completion tokens
+        now = time.monotonic()
+        completion_tokens = count_tokens(answer, model)
+        metrics.completion_seconds.observe(now - start, model=model)
+        metrics.tokens.inc(prompt_tokens, model=model, type="prompt")
+        metrics.tokens.inc(completion_tokens, model=model, type="completion")
+        if first_token is not None and now > first_token:
+            metrics.tokens_per_second.observe(completion_tokens / (now - first_token), model=model)
+        return completion_tokens
+
+    def _retry_or_fail_over(self, model, route, on_retry):
+        # retry callback of one model: an overloaded model is reported to the router, and the answer
+        # continues with another healthy model of the route instead of retrying the same one
+        def retry(attempt, delay, e):
+            self.router.error(model, "overloaded")
+            if self.router.fail_over(route):
+                raise FailOver(model, e)
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+
+        return retry
 
-            except Exception as e:
-                raise ValueError("Unexpected ChatGPT response: {} {}".format(c, e))
+    # async chat function, same as chat but does not block the event loop while streaming
+    # every delta is returned, edits are coalesced by renderer.py
+    # temporary errors are retried by retry.py, on_retry(attempt, delay, error) is called before each retry,
+    # or the answer moves to another model, see router.py. Raises router.BudgetExceeded if the monthly budget is used
+    # trace is an optional metrics.Trace of this request
+    async def chat_async(self, user_id, user_message, on_retry=None, trace=None):
+        trace = trace or metrics.Trace(user_id, False)
+        start = time.monotonic()
+        self.router.check_budget(user_id)
+        conversation, route, pre_answer = self._prepare_chat(user_id, user_message)
+        model = route.model
+        trace.mark("prepare")
+        state = {"status": "", "answer": pre_answer, "last_answer": "", "interval": 0, "coalesce": False, "code": False}
+        temperature = 0.7
+        cache_key = self._first_turn_key(conversation, model, temperature)
+        cached_answer = self.cache.get(cache_key) if cache_key is not None else None
 
+        try:
+            if cached_answer is not None:
+                trace.mark("cache")
+                metrics.answers.inc(model=model, result="cached")
+                async for result in self._replay(user_id, conversation, state, cached_answer):
+                    yield result
+                return
+            while True:
+                model = route.model
+                # wait for rate limit budget without blocking other users
+                prompt_tokens = conversation.count_tokens(model)
+                metrics.rate_limit_seconds.observe(await self.rate_limiter.acquire(user_id, model, prompt_tokens + self.reply_tokens))
+                trace.mark("rate_limit")
+                first_token = None
+                # !TODO make temperature adjustable to different users.
+                completion = stream_with_retry(
+                    lambda: self.async_client.chat.completions.create(
+                        model=model,
+                        stream=True,
+                        messages=self._create_payload(conversation),
+                        temperature=temperature,
+                        timeout=self.network.openai_timeout("chat"),
+                    ),
+                    self.retry_policy,
+                    self._retry_or_fail_over(model, route, on_retry),
+                )
+                try:
+                    async for c in completion:
+                        result = self._process_chunk(user_id, conversation, c, state)
+                        if result is not None:
+                            if first_token is None:
+                                first_token = time.monotonic()
+                                metrics.first_token_seconds.observe(first_token - start, model=model)
+                                self.router.success(model, first_token - start)
+                                # saved with the answer
+                                conversation.model = model
+                                trace.mark("first_token")
+                            yield result
+                    trace.mark("last_token")
+                    completion_tokens = self._record_answer(model, start, first_token, prompt_tokens, state["answer"][len(pre_answer) :])
+                    metrics.answers.inc(model=model, result=state["status"] or "empty")
+                    self.router.charge(user_id, prompt_tokens + completion_tokens)
+                    if cache_key is not None and state["status"] == "finished":
+                        self.cache.put(cache_key, state["answer"][len(pre_answer) :])
+                    return
+                except ContextLengthExceeded as e:
+                    # current messages are too long, forget old messages and try again
+                    _, message = self.reduce_messeges(user_id, e)
+                    logger.info(message)
+                except FailOver as e:
+                    logger.info("User: {} {}, continue with {}".format(user_id, e, route.model))
+                    self._fit_context(user_id, conversation, route.model)
+                except Exception as e:
+                    # retries are used up or the error is fatal, another model can still answer if nothing was sent yet
+                    overloaded = classify_error(e) == "retry"
+                    self.router.error(model, "overloaded" if overloaded else "fatal")
+                    if not overloaded or state["answer"] != pre_answer or not self.router.fail_over(route):
+                        raise
+                    logger.info("User: {} {} failed: {}, continue with {}".format(user_id, model, type(e).__name__, route.model))
+                    self._fit_context(user_id, conversation, route.model)
+                finally:
+                    await completion.aclose()
+        except BaseException as e:
+            metrics.answers.inc(model=model, result="cancelled" if isinstance(e, asyncio.CancelledError) else "error")
+            self._drop_unanswered(user_id, conversation)
+            raise
 
 if __name__ == "__main__":
     with open(os.path.join(os.path.dirname(__file__), "config.json"), "r") as f:
@@ -201,7 +469,7 @@ if __name__ == "__main__":
     user_id = "test"
     user_message = "Hello"
 
-    chatgpt.reset_chat(user_id, default_prompt)
+    chatgpt.reset_chat(user_id, chatgpt.default_prompt)
     completion = chatgpt.chat("test", user_message)
     for c in completion:
         print(c)
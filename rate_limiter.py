@@ -0,0 +1,166 @@
+import time
+import asyncio
+import sqlite3
+
+# OpenAI budgets per model, requests per minute (rpm) and tokens per minute (tpm)
+# these are conservative defaults, change them according to your account tier
+default_model_limits = {
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000},
+    "gpt-4-turbo": {"rpm": 500, "tpm": 30000},
+}
+# used for models not listed above
+fallback_model_limits = {"rpm": 500, "tpm": 30000}
+
+# per user budget, allow a short burst and then a steady rate
+default_user_limits = {"burst": 5, "rpm": 20}
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # seconds to wait until amount is available, requests bigger than the bucket only wait for a full bucket
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class SQLiteTokenBucket:
+    # same as TokenBucket, but the state is kept in a SQLite file so that several processes share the same budget
+    def __init__(self, path, name, capacity, refill_per_second):
+        self.name = name
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        # autocommit mode, transactions are started explicitly
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        self.db.execute("INSERT OR IGNORE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)", (name, capacity, time.time()))
+
+    def _refilled(self):
+        tokens, updated = self.db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)).fetchone()
+        now = time.time()
+        return min(self.capacity, tokens + (now - updated) * self.refill_per_second), now
+
+    def wait_time(self, amount):
+        tokens, _ = self._refilled()
+        amount = min(amount, self.capacity)
+        if tokens >= amount:
+            return 0.0
+        return (amount - tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        # BEGIN IMMEDIATE locks the file, so that two processes do not consume the same tokens
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, now = self._refilled()
+            self.db.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?", (tokens - min(amount, self.capacity), now, self.name))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+
+class RateLimiter:
+    # shared_path: keep the per model budgets in a SQLite file shared by all worker processes (see webhook.py),
+    # per user budgets stay in memory since all messages of a user are handled by the same worker
+    def __init__(self, model_limits=None, user_limits=None, max_wait=60, shared_path=None):
+        self.model_limits = dict(default_model_limits, **(model_limits or {}))
+        self.user_limits = dict(default_user_limits, **(user_limits or {}))
+        # give up if a request waited longer than this (seconds)
+        self.max_wait = max_wait
+        self.shared_path = shared_path
+
+        self.user_buckets = {}
+        self.user_locks = {}
+        self.model_buckets = {}
+        # asyncio.Lock wakes up waiters in FIFO order, so requests to the same model are served fairly
+        self.model_locks = {}
+        # queue wait time metrics per model
+        self.stats = {}
+
+    def _get_user(self, user_id):
+        if user_id not in self.user_buckets:
+            self.user_buckets[user_id] = TokenBucket(self.user_limits["burst"], self.user_limits["rpm"] / 60)
+            self.user_locks[user_id] = asyncio.Lock()
+        return self.user_buckets[user_id], self.user_locks[user_id]
+
+    def _get_model(self, model):
+        if model not in self.model_buckets:
+            limits = self.model_limits.get(model, fallback_model_limits)
+            if self.shared_path is not None:
+                self.model_buckets[model] = (
+                    SQLiteTokenBucket(self.shared_path, model + ":rpm", limits["rpm"], limits["rpm"] / 60),
+                    SQLiteTokenBucket(self.shared_path, model + ":tpm", limits["tpm"], limits["tpm"] / 60),
+                )
+            else:
+                self.model_buckets[model] = (
+                    TokenBucket(limits["rpm"], limits["rpm"] / 60),
+                    TokenBucket(limits["tpm"], limits["tpm"] / 60),
+                )
+            self.model_locks[model] = asyncio.Lock()
+            self.stats[model] = {"requests": 0, "waiting": 0, "total_wait": 0.0, "max_wait": 0.0}
+        return self.model_buckets[model], self.model_locks[model]
+
+    async def _wait_for(self, buckets_and_amounts, deadline):
+        while True:
+            wait = max(bucket.wait_time(amount) for bucket, amount in buckets_and_amounts)
+            if wait <= 0:
+                for bucket, amount in buckets_and_amounts:
+                    bucket.consume(amount)
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitTimeout("RATELIMIT: too many requests, please try again later")
+            await asyncio.sleep(wait)
+
+    def wait_time(self, model, tokens=0):
+        # seconds a request of tokens would wait for the budget of model now, without using it
+        rpm_bucket, tpm_bucket = self._get_model(model)[0]
+        return max(rpm_bucket.wait_time(1), tpm_bucket.wait_time(tokens))
+
+    async def acquire(self, user_id, model, tokens=0):
+        # wait (without blocking the event loop) until both the user and the model have budget left
+        (rpm_bucket, tpm_bucket), model_lock = self._get_model(model)
+        user_bucket, user_lock = self._get_user(user_id)
+        stats = self.stats[model]
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        stats["waiting"] += 1
+        try:
+            # a user that sends too many requests only waits on their own bucket, others are not affected
+            async with user_lock:
+                await self._wait_for([(user_bucket, 1)], deadline)
+            async with model_lock:
+                await self._wait_for([(rpm_bucket, 1), (tpm_bucket, tokens)], deadline)
+        finally:
+            stats["waiting"] -= 1
+        wait = time.monotonic() - start
+        stats["requests"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        return wait
+
+    def get_stats(self):
+        result = {}
+        for model, stats in self.stats.items():
+            result[model] = dict(stats, avg_wait=stats["total_wait"] / stats["requests"] if stats["requests"] else 0.0)
+        return result
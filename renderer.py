@@ -0,0 +1,405 @@
+import re
+import time
+import bisect
+import asyncio
+import datetime
+from md2tgmd import escape
+from telegram.constants import ParseMode, MessageLimit
+from telegram.error import RetryAfter, BadRequest
+from rate_limiter import TokenBucket
+import metrics
+
+
+def _seconds(retry_after):
+    # RetryAfter.retry_after is an int or a timedelta depending on the version of python-telegram-bot
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def close_code_block(text):
+    # close an unfinished code block so that a partial answer can still be rendered
+    if text.count("```") % 2 == 1:
+        return text + "\n```"
+    return text
+
+
+def reopen_code_block(text):
+    # fence to put at the beginning of the next message if text ends inside a code block, e.g. "```python\n"
+    if text.count("```") % 2 == 0:
+        return ""
+    start = text.rfind("```") + 3
+    end = text.find("\n", start)
+    language = text[start:end].strip() if end != -1 else ""
+    return "```" + language + "\n"
+
+
+def find_split(text, target):
+    # find a safe position to split text before target: a paragraph outside of code blocks,
+    # then a new line, then a space, and a hard cut if nothing else is found
+    window = text[:target]
+    position = window.rfind("\n\n")
+    while position > target // 2:
+        if window[:position].count("```") % 2 == 0:
+            return position
+        position = window.rfind("\n\n", 0, position)
+    for separator in ("\n", " "):
+        position = window.rfind(separator)
+        if position > target // 2:
+            return position
+    return target
+
+
+# md2tgmd.escape is a chain of regular expressions over the whole text. Most of them only look at one line,
+# a few can continue over several lines: code blocks, inline code, latex blocks and the "@@@" placeholders it uses.
+# a paragraph that starts with a letter, no list, quote, heading, code or latex at the beginning of the line
+_paragraph = re.compile(r"\n\n(?=[^\W\d_])")
+# the last step of md2tgmd.escape, code blocks that follow a new line
+_code_block = re.compile(r"\n+\x20*```[\D\d\s]+?```\n+")
+
+
+def _closed(segment):
+    # True if nothing that md2tgmd.escape matches over several lines is still open at the end of segment.
+    # Only plain markdown is accepted: fences on their own lines, and inline code that ends on the same line
+    if "@@@" in segment or "\\`" in segment or "````" in segment:
+        return False
+    start = segment.rfind("\\[")
+    if start != -1 and segment.find("\\]", start) == -1:
+        return False
+    in_code = False
+    for line in segment.split("\n"):
+        if "```" in line:
+            if line.count("```") != 1 or not line.lstrip(" ").startswith("```"):
+                return False
+            in_code = not in_code
+        elif not in_code and (line.count("`") % 2 == 1 or "``" in line):
+            return False
+    if in_code:
+        return False
+    # a fence that md2tgmd does not see as the start of a code block (e.g. at the very beginning, or right after
+    # another code block) would be paired with a fence after the segment
+    position = 0
+    for match in _code_block.finditer(segment):
+        if "```" in segment[position : match.start()]:
+            return False
+        position = match.end()
+    return "```" not in segment[position:]
+
+
+class MarkdownEscaper:
+    # md2tgmd.escape of a text that grows while it is streamed, without escaping the whole text for every update:
+    # the escaped text up to the last paragraph where nothing is open is kept, and only the text after it is escaped.
+    # escape(a + b) == escape(a) + escape(b) if a ends with such a paragraph break, see the check in __main__
+    def __init__(self):
+        # source is a prefix of the text that ends at a safe paragraph, escaped is escape(source)
+        self.source = ""
+        self.escaped = ""
+
+    def _advance(self, text):
+        if not text.startswith(self.source):
+            # not the same text anymore, e.g. the next message of a long answer
+            self.source = ""
+            self.escaped = ""
+        start = len(self.source)
+        tail = text[start:]
+        candidates = [match.end() for match in _paragraph.finditer(tail)]
+        if not candidates:
+            return
+        # skip the paragraphs inside code blocks without checking them
+        fences = [match.start() for match in re.finditer("```", tail)]
+        for position in reversed(candidates):
+            if bisect.bisect_left(fences, position) % 2 == 0 and _closed(tail[:position]):
+                self.source = text[: start + position]
+                self.escaped += escape(tail[:position])
+                return
+
+    def code_block_open(self, text):
+        # True if text ends inside a code block
+        self._advance(text)
+        return text.count("```", len(self.source)) % 2 == 1
+
+    def escape(self, text, suffix=""):
+        # same as md2tgmd.escape(text + suffix), suffix is not cached
+        self._advance(text)
+        return self.escaped + escape(text[len(self.source) :] + suffix)
+
+
+class EditScheduler:
+    # shared by all chats of one bot: at most one edit per chat every chat_interval seconds,
+    # and at most global_rate edits per second for the whole bot
+    def __init__(self, chat_interval=1.0, global_rate=20):
+        self.chat_interval = chat_interval
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.next_edit = {}
+
+    async def wait_turn(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = max(self.next_edit.get(chat_id, 0) - now, self.bucket.wait_time(1))
+            if wait <= 0:
+                self.bucket.consume(1)
+                self.next_edit[chat_id] = now + self.chat_interval
+                self._cleanup(now)
+                return
+            await asyncio.sleep(wait)
+
+    def back_off(self, chat_id, seconds):
+        # telegram asked us to slow down, no edit for this chat before the given time
+        self.next_edit[chat_id] = max(self.next_edit.get(chat_id, 0), time.monotonic() + seconds)
+
+    def _cleanup(self, now):
+        # forget chats that can edit again anyway, keeps the dict small
+        if len(self.next_edit) > 10000:
+            self.next_edit = {chat_id: t for chat_id, t in self.next_edit.items() if t > now}
+
+    def renderer(self, bot, chat_id, message_id, logger=None):
+        return StreamRenderer(self, bot, chat_id, message_id, logger)
+
+
+class StreamRenderer:
+    # renders a streamed answer into telegram messages, edits are coalesced in the background
+    # so that the stream is never blocked by telegram.
+    # answers longer than one telegram message continue in new messages, only the last message is edited
+    def __init__(self, scheduler, bot, chat_id, message_id, logger=None, limit=MessageLimit.MAX_TEXT_LENGTH):
+        self.scheduler = scheduler
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.logger = logger
+        self.limit = limit
+
+        self.text = ""
+        self.final = False
+        self.rendered = None
+        self.task = None
+        self.edits = 0
+        # seconds from creating the renderer (after sending the placeholder message) to the first edit
+        self.created = time.monotonic()
+        self.first_edit = None
+        # all messages used by this answer, the last one is being edited
+        self.message_ids = [message_id]
+        # the last message shows prefix + text[offset:], prefix reopens a code block that was split
+        self.offset = 0
+        self.prefix = ""
+        # escaped text of the last message, only the new part is escaped again for every edit
+        self.markdown = MarkdownEscaper()
+
+    def _tail(self):
+        return self.prefix + self.text[self.offset :]
+
+    def _render(self):
+        tail = self._tail()
+        if self.final:
+            return self.markdown.escape(tail)
+        # close an unfinished code block so that the partial answer can still be rendered, same as close_code_block
+        return self.markdown.escape(tail, "\n```..." if self.markdown.code_block_open(tail) else "...")
+
+    def update(self, text):
+        # non blocking, only the latest text is sent when it is our turn to edit
+        self.text = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush())
+
+    async def finish(self, text):
+        self.text = text
+        self.final = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush())
+        await self.task
+        metrics.edits_per_answer.observe(self.edits)
+
+    async def close(self):
+        # stop pending edits without sending anything, e.g. when the answer is cancelled
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _roll_over(self):
+        # move the beginning of the tail into a finished message until the rest fits in one message
+        while len(self._render()) > self.limit:
+            tail = self._tail()
+            # leave some room for the closing fence and "..."
+            target = self.limit - 16
+            while True:
+                position = find_split(tail, target)
+                head = close_code_block(tail[:position])
+                if len(escape(head)) <= self.limit or position <= len(self.prefix) + 1:
+                    break
+                # escaping made it too long, try again with a shorter part
+                target = position * 9 // 10
+            await self._edit_final(head)
+
+            prefix = reopen_code_block(tail[:position])
+            rest = tail[position:]
+            # do not start the next message with empty lines, but keep empty lines inside code blocks
+            skip = len(rest) - len(rest.lstrip("\n"))
+            if prefix:
+                skip = min(skip, 1)
+            self.offset += position - len(self.prefix) + skip
+            self.prefix = prefix
+
+            await self.scheduler.wait_turn(self.chat_id)
+            message = await self.bot.send_message(self.chat_id, "...")
+            self.message_id = message.message_id
+            self.message_ids.append(self.message_id)
+            self.rendered = None
+
+    async def _edit(self, text, parse_mode=None):
+        # all edits go through here so that their latency is measured
+        start = time.monotonic()
+        try:
+            await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, parse_mode=parse_mode)
+        except Exception as e:
+            metrics.edits.inc(result=type(e).__name__)
+            raise
+        now = time.monotonic()
+        metrics.edit_seconds.observe(now - start)
+        metrics.edits.inc(result="ok")
+        if self.first_edit is None:
+            self.first_edit = now - self.created
+            metrics.first_edit_seconds.observe(self.first_edit)
+
+    async def _edit_final(self, text):
+        # edit the current message for the last time, wait and try again if telegram asks us to slow down
+        rendered = escape(text)
+        while True:
+            await self.scheduler.wait_turn(self.chat_id)
+            try:
+                await self._edit(rendered, ParseMode.MARKDOWN_V2)
+            except RetryAfter as e:
+                self._back_off(e)
+                continue
+            except BadRequest as e:
+                if "not modified" not in str(e):
+                    # not valid MarkdownV2, send it as plain text instead
+                    await self._edit(text)
+            self.edits += 1
+            return
+
+    def _back_off(self, e):
+        seconds = _seconds(e.retry_after)
+        if self.logger is not None:
+            self.logger.info(f"Chat: {str(self.chat_id)} Telegram flood control, wait {seconds} seconds.")
+        self.scheduler.back_off(self.chat_id, seconds)
+
+    async def _flush(self):
+        while True:
+            await self._roll_over()
+            rendered = self._render()
+            if rendered == self.rendered:
+                # nothing changed since the last edit
+                return
+            await self.scheduler.wait_turn(self.chat_id)
+            # the text may have grown while waiting, always send the latest one
+            await self._roll_over()
+            final = self.final
+            rendered = self._render()
+            if rendered == self.rendered:
+                return
+            try:
+                await self._edit(rendered, ParseMode.MARKDOWN_V2)
+                self.rendered = rendered
+                self.edits += 1
+            except RetryAfter as e:
+                self._back_off(e)
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    self.rendered = rendered
+                elif final:
+                    # the final answer is not valid MarkdownV2, send it as plain text instead
+                    await self._edit(self._tail())
+                    self.rendered = rendered
+                    self.edits += 1
+                else:
+                    # partial markdown can be invalid, skip this update and wait for more text
+                    self.rendered = rendered
+            except Exception as e:
+                if final:
+                    raise e
+                # a failed intermediate edit is not fatal, the next update will try again
+                if self.logger is not None:
+                    self.logger.info(f"Chat: {str(self.chat_id)} Edit failed: {str(e)}")
+                # finish() waits for this task, there is no next update to send the final text
+                if not self.final:
+                    return
+
+
+if __name__ == "__main__":
+    # check that MarkdownEscaper gives the same result as md2tgmd.escape on random streamed answers,
+    # then compare the time to render every update of a long answer with code
+    import random
+
+    fragments = [
+        "Hello", "world", "这是", "テスト", "word", " ", " ", " ", "\n", "\n", "\n\n", "\n\n", "\n\n\n", ".", "!", "?", ",",
+        "```python\n", "```\n", "```", "`", "``", "\\`", "*", "**", "_", "__", "~~", "-", "- ", "+", "=", "|", "{", "}", "(", ")",
+        "[", "]", "[link](https://example.com)", "# ", "## Title\n", "> ", ">", "1. ", "10. ", "* ", "\\[", "\\]", "\\(x^2\\)",
+        "\\", "@", "@@@", "#", "    ", "\t", "def f(x):\n    return x + 1\n", "a_b", "x**2", "2 - 1 = 1",
+    ]
+
+    def random_answer(length):
+        return "".join(random.choice(fragments) for _ in range(length))
+
+    def stream(text):
+        # split text into deltas of random size like the openai stream
+        position = 0
+        while position < len(text):
+            position += random.randint(1, 12)
+            yield text[:position]
+
+    blocks = [
+        "Use `asyncio.gather` to run **several** tasks (see [docs](https://docs.python.org)).",
+        "This is a _simple_ answer, no markdown at all! It costs 2 + 2 = 4 {tokens}.",
+        "```python\ndef f(x):\n    return x * 2  # `double`\n\nprint(f(1))\n```",
+        "    ```bash\n    pip install -r requirements.txt\n    ```",
+        "- first item\n- second item with `code`\n  - nested item",
+        "1. step one\n2. step two\n10. step ten",
+        "* star item\n* another ~~old~~ item",
+        "## Heading\nText under the heading.",
+        "> quoted text\n> more quote",
+        "The formula is \\(x^2 + y^2\\) and\n\\[\nE = mc^2\n\\]",
+        "Table | with | pipes\n--- | --- | ---",
+        "日本語の説明です。これは`コード`です。",
+        "你好，这是一个**例子**。",
+    ]
+
+    def random_structured_answer(length):
+        return "\n\n".join(random.choice(blocks) for _ in range(length))
+
+    random.seed(0)
+    checked = 0
+    cached = 0
+    answers = [random_answer(random.randint(1, 120)) for _ in range(2000)] + [random_structured_answer(random.randint(1, 12)) for _ in range(500)]
+    for answer in answers:
+        markdown = MarkdownEscaper()
+        for partial in stream(answer):
+            for suffix in ("", "...", "\n```..."):
+                expected = escape(partial + suffix)
+                result = markdown.escape(partial, suffix)
+                assert result == expected, (partial, suffix, result, expected)
+                checked += 1
+                cached += len(markdown.source)
+        assert markdown.code_block_open(answer) == (answer.count("```") % 2 == 1)
+    print(f"{checked} partial answers escaped the same as md2tgmd.escape, {cached} characters were not escaped again")
+
+    # long answer with code, rendered after every delta of about 4 characters
+    paragraph = "Here is an example of how to use **asyncio** with `await`, it runs tasks concurrently.\n\n"
+    code = "```python\nimport asyncio\n\nasync def main():\n    await asyncio.sleep(1)\n    print(\"done\")\n\nasyncio.run(main())\n```\n\n"
+    answer = (paragraph * 2 + code) * 12
+    updates = list(range(4, len(answer), 4)) + [len(answer)]
+    start = time.perf_counter()
+    for end in updates:
+        close_code_block(answer[:end])
+        escape(answer[:end] + "...")
+    full_time = time.perf_counter() - start
+    markdown = MarkdownEscaper()
+    start = time.perf_counter()
+    for end in updates:
+        markdown.escape(answer[:end], "\n```..." if markdown.code_block_open(answer[:end]) else "...")
+    incremental_time = time.perf_counter() - start
+    print(
+        f"{len(answer)} characters, {len(updates)} updates: full escape {full_time * 1000:.0f} ms, "
+        f"incremental {incremental_time * 1000:.0f} ms ({full_time / incremental_time:.1f}x faster)"
+    )
@@ -0,0 +1,326 @@
+import time
+import random
+import asyncio
+import openai
+import metrics
+
+
+class ContextLengthExceeded(Exception):
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, max_retry=5, base_delay=1.0, max_delay=20.0, timeout=60, request_timeout=30, stall_timeout=20):
+        self.max_retry = max_retry
+        # exponential backoff: base_delay * 2 ** attempt, capped by max_delay, with full jitter
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # total time allowed for all attempts and retries, for streams only until the first chunk,
+        # after that a long answer may take as long as it needs as long as it does not stall
+        self.timeout = timeout
+        # time allowed to get the response (or the first byte of a stream) of one attempt
+        self.request_timeout = request_timeout
+        # time allowed between two chunks of a stream
+        self.stall_timeout = stall_timeout
+
+    def backoff(self, attempt, error=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        wait = retry_after(error)
+        if wait is not None:
+            delay = max(delay, wait)
+        return delay
+
+
+def retry_after(error):
+    # seconds to wait as told by the server, if any
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    for header in ("retry-after-ms", "retry-after"):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000 if header == "retry-after-ms" else seconds
+    return None
+
+
+def classify_error(error):
+    # "retry" for temporary errors, "context" if the messages are too long, "fatal" otherwise
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return "retry"
+    if isinstance(error, openai.RateLimitError):
+        # running out of quota will not get better by retrying
+        return "fatal" if getattr(error, "code", None) == "insufficient_quota" else "retry"
+    if isinstance(error, openai.BadRequestError) and getattr(error, "code", None) == "context_length_exceeded":
+        return "context"
+    if isinstance(error, openai.APIStatusError) and (error.status_code >= 500 or error.status_code in (408, 409)):
+        return "retry"
+    return "fatal"
+
+
+def _raise_classified(error):
+    if classify_error(error) == "context":
+        raise ContextLengthExceeded(str(error)) from error
+    raise error
+
+
+async def call_with_retry(func, policy=None, on_retry=None):
+    # func is called without arguments and returns an awaitable, it is called again for every attempt
+    policy = policy or RetryPolicy()
+    deadline = time.monotonic() + policy.timeout
+    attempt = 0
+    while True:
+        try:
+            remaining = deadline - time.monotonic()
+            return await asyncio.wait_for(func(), min(policy.request_timeout, max(remaining, 0)))
+        except Exception as e:
+            delay = policy.backoff(attempt, e)
+            attempt += 1
+            if classify_error(e) != "retry" or attempt > policy.max_retry or time.monotonic() + delay > deadline:
+                _raise_classified(e)
+            metrics.retries.inc(error=type(e).__name__)
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+            await asyncio.sleep(delay)
+
+
+def call_with_retry_sync(func, policy=None, on_retry=None):
+    # blocking version of call_with_retry for code that runs in threads, e.g. get_prompt called by the generative model.
+    # a thread cannot be cancelled, so func must time out by itself (the http timeout of the client)
+    policy = policy or RetryPolicy()
+    deadline = time.monotonic() + policy.timeout
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            delay = policy.backoff(attempt, e)
+            attempt += 1
+            if classify_error(e) != "retry" or attempt > policy.max_retry or time.monotonic() + delay > deadline:
+                _raise_classified(e)
+            metrics.retries.inc(error=type(e).__name__)
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+            time.sleep(delay)
+
+
+async def stream_with_retry(func, policy=None, on_retry=None):
+    # func returns an awaitable of an async stream, the stream is only opened again if nothing was yielded yet,
+    # otherwise the error is raised to the caller since the partial answer has already been sent
+    policy = policy or RetryPolicy()
+    deadline = time.monotonic() + policy.timeout
+    attempt = 0
+    while True:
+        stream = None
+        started = False
+        try:
+            remaining = deadline - time.monotonic()
+            stream = await asyncio.wait_for(func(), min(policy.request_timeout, max(remaining, 0)))
+            iterator = stream.__aiter__()
+            while True:
+                if started:
+                    timeout = policy.stall_timeout
+                else:
+                    timeout = min(policy.stall_timeout, max(deadline - time.monotonic(), 0))
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+                except StopAsyncIteration:
+                    return
+                started = True
+                yield chunk
+        except Exception as e:
+            delay = policy.backoff(attempt, e)
+            attempt += 1
+            if started or classify_error(e) != "retry" or attempt > policy.max_retry or time.monotonic() + delay > deadline:
+                _raise_classified(e)
+            metrics.retries.inc(error=type(e).__name__)
+            if on_retry is not None:
+                on_retry(attempt, delay, e)
+            await asyncio.sleep(delay)
+        finally:
+            # release the connection if the stream failed or the consumer stopped early
+            if stream is not None and hasattr(stream, "close"):
+                await stream.close()
+
+
+if __name__ == "__main__":
+    # check the retry layer against a local stub of the openai api that answers with scripted errors and stalls
+    import json
+    from openai import OpenAI, AsyncOpenAI
+
+    # one entry per request, in order: ("status", code, headers, error code), ("stall",) before the headers,
+    # ("stream", chunks, stall) to send chunks and then stall if stall is True, ("slow", chunks, interval) to send
+    # chunks interval seconds apart, ("ok",) for a normal answer.
+    # a stall lasts until the client gives up and closes the connection
+    script = []
+    requests = []
+
+    def error_body(code):
+        return json.dumps({"error": {"message": "stub error", "type": "stub", "code": code}}).encode()
+
+    def chunk(content, finish_reason=None):
+        delta = {"content": content} if content is not None else {}
+        data = {"id": "x", "object": "chat.completion.chunk", "created": 0, "model": "stub", "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(data)}\n\n".encode()
+
+    async def handle(reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = [line for line in head.decode().split("\r\n") if line.lower().startswith("content-length")][0]
+            await reader.readexactly(int(length.split(":")[1]))
+            step = script.pop(0) if script else ("ok",)
+            requests.append(step[0])
+            if step[0] == "status":
+                _, code, headers, error_code = step
+                body = error_body(error_code)
+                extra = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+                writer.write(f"HTTP/1.1 {code} Stub\r\ncontent-type: application/json\r\n{extra}content-length: {len(body)}\r\n\r\n".encode() + body)
+            elif step[0] == "stall":
+                await reader.read()
+            elif step[0] == "stream":
+                _, chunks, stall = step
+                writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\nconnection: close\r\n\r\n")
+                for _ in range(chunks):
+                    writer.write(chunk("word "))
+                    await writer.drain()
+                if stall:
+                    await reader.read()
+                writer.write(chunk(None, "stop") + b"data: [DONE]\n\n")
+            elif step[0] == "slow":
+                _, chunks, interval = step
+                writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\nconnection: close\r\n\r\n")
+                for _ in range(chunks):
+                    writer.write(chunk("word "))
+                    await writer.drain()
+                    await asyncio.sleep(interval)
+                writer.write(chunk(None, "stop") + b"data: [DONE]\n\n")
+            else:
+                body = json.dumps({
+                    "id": "x", "object": "chat.completion", "created": 0, "model": "stub",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                }).encode()
+                writer.write(f"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\ncontent-length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def run(steps):
+        script[:] = steps
+        requests.clear()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        base_url = "http://127.0.0.1:{}/v1".format(server.sockets[0].getsockname()[1])
+        client = AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=0)
+        sync_client = OpenAI(api_key="stub", base_url=base_url, max_retries=0)
+        policy = RetryPolicy(max_retry=3, base_delay=0.01, max_delay=0.05, timeout=10, request_timeout=0.5, stall_timeout=0.5)
+        messages = [{"role": "user", "content": "hi"}]
+        delays = []
+
+        def on_retry(attempt, delay, e):
+            delays.append((delay, type(e).__name__))
+
+        def create():
+            return client.chat.completions.create(model="stub", messages=messages)
+
+        def create_stream():
+            return client.chat.completions.create(model="stub", messages=messages, stream=True)
+
+        async def collect(stream):
+            return [c.choices[0].delta.content async for c in stream if c.choices[0].delta.content]
+
+        # 429 with retry-after, then 503, then an answer: the first delay honours the header
+        run([("status", 429, {"retry-after": "0.3"}, "rate_limit_exceeded"), ("status", 503, {}, None), ("ok",)])
+        delays.clear()
+        response = await call_with_retry(create, policy, on_retry)
+        assert response.choices[0].message.content == "ok" and requests == ["status", "status", "ok"], requests
+        assert delays[0][0] >= 0.3 and delays[1][0] <= 0.05, delays
+        print("call_with_retry: 429 and 503 retried, retry-after honoured", delays)
+
+        # retry-after-ms is in milliseconds
+        run([("status", 429, {"retry-after-ms": "200"}, "rate_limit_exceeded"), ("ok",)])
+        delays.clear()
+        await call_with_retry(create, policy, on_retry)
+        assert 0.2 <= delays[0][0] < 0.3, delays
+        print("call_with_retry: retry-after-ms honoured", delays)
+
+        # a request without any response times out after request_timeout and is sent again
+        run([("stall",), ("ok",)])
+        delays.clear()
+        await call_with_retry(create, policy, on_retry)
+        assert requests == ["stall", "ok"] and delays[0][1] == "TimeoutError", (requests, delays)
+        print("call_with_retry: stalled request timed out and retried")
+
+        # quota errors and bad requests are not retried
+        run([("status", 429, {}, "insufficient_quota"), ("ok",)])
+        try:
+            await call_with_retry(create, policy, on_retry)
+            raise AssertionError("insufficient_quota was retried")
+        except openai.RateLimitError:
+            assert requests == ["status"], requests
+        print("call_with_retry: insufficient_quota not retried")
+
+        # context_length_exceeded becomes ContextLengthExceeded, for both calls and streams
+        for call in (lambda: call_with_retry(create, policy, on_retry), lambda: collect(stream_with_retry(create_stream, policy, on_retry))):
+            run([("status", 400, {}, "context_length_exceeded"), ("ok",)])
+            try:
+                await call()
+                raise AssertionError("context_length_exceeded was not raised")
+            except ContextLengthExceeded:
+                assert requests == ["status"], requests
+        print("call_with_retry, stream_with_retry: context_length_exceeded raised as ContextLengthExceeded")
+
+        # a stream that fails or stalls before the first chunk is opened again
+        run([("status", 502, {}, None), ("stream", 0, True), ("stream", 3, False)])
+        delays.clear()
+        words = await collect(stream_with_retry(create_stream, policy, on_retry))
+        assert words == ["word "] * 3 and requests == ["status", "stream", "stream"], (words, requests)
+        assert [name for _, name in delays] == ["InternalServerError", "TimeoutError"], delays
+        print("stream_with_retry: error and stall before the first chunk retried")
+
+        # a stream that stalls after the first chunk times out per chunk and is not opened again
+        run([("stream", 2, True), ("stream", 3, False)])
+        delays.clear()
+        words = []
+        start = time.monotonic()
+        try:
+            async for c in stream_with_retry(create_stream, policy, on_retry):
+                if c.choices[0].delta.content:
+                    words.append(c.choices[0].delta.content)
+            raise AssertionError("stalled stream did not time out")
+        except asyncio.TimeoutError:
+            elapsed = time.monotonic() - start
+        assert words == ["word "] * 2 and requests == ["stream"] and not delays, (words, requests, delays)
+        assert policy.stall_timeout <= elapsed < policy.stall_timeout + 0.5, elapsed
+        print(f"stream_with_retry: stall after the first chunk raised after {elapsed:.2f} s, not reopened")
+
+        # a long answer that keeps sending chunks may take longer than policy.timeout
+        run([("slow", 15, 0.1)])
+        start = time.monotonic()
+        words = await collect(stream_with_retry(create_stream, RetryPolicy(timeout=0.5, request_timeout=0.5, stall_timeout=0.5), on_retry))
+        elapsed = time.monotonic() - start
+        assert words == ["word "] * 15 and elapsed > 0.5, (words, elapsed)
+        print(f"stream_with_retry: stream of {elapsed:.2f} s completed with a total timeout of 0.5 s")
+
+        # the blocking version used by get_prompt, in a thread like in the bot
+        run([("status", 429, {"retry-after": "0.2"}, "rate_limit_exceeded"), ("status", 500, {}, None), ("ok",)])
+        delays.clear()
+        response = await asyncio.get_running_loop().run_in_executor(
+            None, call_with_retry_sync, lambda: sync_client.chat.completions.create(model="stub", messages=messages, timeout=0.5), policy, on_retry
+        )
+        assert response.choices[0].message.content == "ok" and requests == ["status", "status", "ok"], requests
+        assert delays[0][0] >= 0.2, delays
+        print("call_with_retry_sync: 429 and 500 retried, retry-after honoured")
+
+        await client.close()
+        sync_client.close()
+        server.close()
+        print("all checks passed")
+
+    asyncio.run(main())
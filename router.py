@@ -0,0 +1,205 @@
+import time
+import sqlite3
+import datetime
+import threading
+import metrics
+
+# choose the model of each answer, configured with the optional "router" part of config.json, e.g.
+# "router": {"models": {"gpt-4o-mini": {"tier": "fast", "cost": 0.15}}, "monthly_tokens": 2000000, "users": {"123": 10000000}}
+# The user chooses a tier with /gpt4, the router picks the healthy model of that tier with the lowest latency
+# and moves to another model when the chosen one fails, also in the middle of the retries of one answer.
+# Only models that cost at most as much as the chosen tier are used, unless "allow_upgrade" is true.
+
+# tier of each model and cost in dollars per million tokens, used to prefer cheaper models when the budget runs low
+default_models = {
+    "gpt-3.5-turbo": {"tier": "fast", "cost": 0.5},
+    "gpt-4-turbo": {"tier": "advanced", "cost": 10.0},
+}
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class FailOver(Exception):
+    # raised from the retry callback to continue the answer with another model
+    def __init__(self, model, error):
+        super().__init__(f"{model} failed: {type(error).__name__}")
+        self.model = model
+        self.error = error
+
+
+class ModelHealth:
+    # exponentially weighted moving averages of the time to first token and of the error rate of one model
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        # no requests until this time (time.monotonic) after the model was overloaded
+        self.cooldown_until = 0.0
+
+    def success(self, latency):
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.error_rate = (1 - self.alpha) * self.error_rate
+
+    def error(self, cooldown=0.0):
+        self.error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+        if cooldown > 0:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+
+
+class Route:
+    # the models that may answer one message, best first
+    def __init__(self, models):
+        self.models = models
+        self.index = 0
+
+    @property
+    def model(self):
+        return self.models[self.index]
+
+    def next(self):
+        # move to the next model, False if there is none left
+        if self.index + 1 >= len(self.models):
+            return False
+        self.index += 1
+        return True
+
+
+class Router:
+    def __init__(self, models=None, monthly_tokens=None, users=None, rate_limiter=None, path=None,
+                 max_error_rate=0.5, cooldown=30.0, tier_penalty=10.0, max_rate_wait=5.0, low_budget=0.8, allow_upgrade=False):
+        self.models = dict(default_models, **(models or {}))
+        self.set_budgets(monthly_tokens, users)
+        self.rate_limiter = rate_limiter
+        # a model is skipped if its error rate is above max_error_rate or it was overloaded less than cooldown seconds ago
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        # seconds added to the score of a model of another tier than the one chosen by the user
+        self.tier_penalty = tier_penalty
+        # models that would wait longer than this for the rate limit are skipped
+        self.max_rate_wait = max_rate_wait
+        # above this fraction of the monthly budget, cheaper models are preferred
+        self.low_budget = low_budget
+        # also fail over to models that cost more than the models of the chosen tier
+        self.allow_upgrade = allow_upgrade
+        self.health = {model: ModelHealth() for model in self.models}
+
+        # tokens used per (user id, month), kept in a SQLite file if path is set so that it survives restarts
+        self.usage = {}
+        self.db = None
+        if path is not None:
+            self.lock = threading.Lock()
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS usage (user_id TEXT, month TEXT, tokens INTEGER, PRIMARY KEY (user_id, month))")
+            self.db.commit()
+
+    def _health(self, model):
+        if model not in self.health:
+            self.health[model] = ModelHealth()
+        return self.health[model]
+
+    def healthy(self, model):
+        health = self._health(model)
+        return health.error_rate <= self.max_error_rate and time.monotonic() >= health.cooldown_until
+
+    # budget
+
+    def set_budgets(self, monthly_tokens=None, users=None):
+        # tokens per user and month, None for no limit, users overrides it per user id
+        self.monthly_tokens = monthly_tokens
+        self.users = {str(user_id): tokens for user_id, tokens in (users or {}).items()}
+
+    @staticmethod
+    def _month():
+        return datetime.date.today().strftime("%Y-%m")
+
+    def budget(self, user_id):
+        return self.users.get(str(user_id), self.monthly_tokens)
+
+    def used(self, user_id):
+        key = (str(user_id), self._month())
+        if key not in self.usage and self.db is not None:
+            with self.lock:
+                row = self.db.execute("SELECT tokens FROM usage WHERE user_id = ? AND month = ?", key).fetchone()
+            self.usage[key] = row[0] if row is not None else 0
+        return self.usage.get(key, 0)
+
+    def check_budget(self, user_id):
+        budget = self.budget(user_id)
+        if budget is not None and self.used(user_id) >= budget:
+            raise BudgetExceeded(f"BUDGET: {budget} tokens per month are used, the budget is renewed next month")
+
+    def charge(self, user_id, tokens):
+        key = (str(user_id), self._month())
+        self.usage[key] = self.used(user_id) + tokens
+        if self.db is not None:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO usage (user_id, month, tokens) VALUES (?, ?, ?)", key + (self.usage[key],))
+                self.db.commit()
+
+    # routing
+
+    def _candidates(self, tier):
+        # models that may answer for tier: the models of the tier and cheaper ones
+        if self.allow_upgrade:
+            return list(self.models)
+        costs = [config.get("cost", 0.0) for config in self.models.values() if config.get("tier") == tier]
+        if not costs:
+            # unknown tier, only the cheapest models
+            costs = [min(config.get("cost", 0.0) for config in self.models.values())]
+        return [model for model, config in self.models.items() if config.get("cost", 0.0) <= max(costs)]
+
+    def route(self, user_id, tier, tokens=0):
+        # models to try for one answer of user_id, best first. tier is the tier chosen by the user ("fast" or "advanced")
+        budget = self.budget(user_id)
+        low_budget = budget is not None and self.used(user_id) >= self.low_budget * budget
+
+        def score(model):
+            health = self._health(model)
+            config = self.models[model]
+            # unknown latency counts as fast so that every model gets tried
+            seconds = health.latency or 0.0
+            if self.rate_limiter is not None:
+                seconds += self.rate_limiter.wait_time(model, tokens)
+            if config.get("tier") != tier:
+                seconds += self.tier_penalty
+            if low_budget:
+                # cost first, then latency
+                return (not self.healthy(model), config.get("cost", 0.0), seconds)
+            return (not self.healthy(model), seconds, config.get("cost", 0.0))
+
+        models = sorted(self._candidates(tier), key=score)
+        if self.rate_limiter is not None:
+            # models that would wait too long go last, but are still tried if nothing else is left
+            models.sort(key=lambda model: self.rate_limiter.wait_time(model, tokens) > self.max_rate_wait)
+        return Route(models)
+
+    def success(self, model, latency):
+        self._health(model).success(latency)
+
+    def error(self, model, error_type):
+        # error_type is "overloaded" (rate limit, server error, timeout) or "fatal"
+        self._health(model).error(self.cooldown if error_type == "overloaded" else 0.0)
+
+    def fail_over(self, route):
+        # move route to the next healthy model after an error of route.model, returns False if there is none
+        failed, index = route.model, route.index
+        while route.next():
+            if self.healthy(route.model):
+                metrics.failovers.inc(source=failed, target=route.model)
+                return True
+        route.index = index
+        return False
+
+    def get_stats(self):
+        return {
+            model: {"latency": health.latency, "error_rate": health.error_rate, "healthy": self.healthy(model)}
+            for model, health in self.health.items()
+        }
+
+
+def create_router(config=None, rate_limiter=None):
+    # build the router from the "router" part of config.json
+    config = dict(config or {})
+    return Router(rate_limiter=rate_limiter, **config)
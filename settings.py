@@ -0,0 +1,133 @@
+import os
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# config.json and whitelist.json, loaded once into the structures the handlers use and reloaded when the files change.
+# The whitelist, the chat modes and the "router" budgets take effect without a restart,
+# other parts of config.json (keys, network, stores) are only read at start.
+
+# chat modes, one command each: system prompt, welcome message and name in the log.
+# A mode without prompt only sends its welcome message (custom mode, the prompt is set with SYSTEMPROMPT:).
+# Add or change modes with the optional "modes" part of config.json, e.g.
+# "modes": {"sql": {"prompt": "You are a concise SQL assistant.", "welcome": "Welcome to SQL Mode!", "name": "SQL Mode"}}
+default_modes = {
+    "start": {
+        "prompt": "You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible using the same language to the user",
+        "welcome": "Welcome to ChatGPT, an AI chatbot powered by GPT-3.5-turbo. I'm here to assist you with various language-related tasks. \nAs a language model, I can help you with:\n- Generating text\n- Answering questions\n- Translating text\n- Summarizing long blocks of text\n- Completing forms\n- Generating recommendations\n- Natural language processing\n- Sentiment analysis\n- Providing general knowledge or trivia\n- Scheduling appointments\n\nPlease keep in mind that these are not the only things I can do. If you have a specific request, feel free to ask me! Let's get started."
+        + "\n\nI'm able to remember what we've talked within 24 hours. If you want to clear the chat history manually, you can send 'clear' to me.",
+        "name": "Default Chat Mode",
+    },
+    "python": {
+        "prompt": "You are a concise Python assistant that responds to future inquiries within [```] blocks.",
+        "welcome": "Welcome to Python Mode! You can ask me to write Python code according to your needs!",
+        "name": "Python Mode",
+    },
+    "cpp": {
+        "prompt": "You are a concise C++ assistant that responds to future inquiries within [```] blocks.",
+        "welcome": "Welcome to C++ Mode! You can ask me to write C++ code according to your needs!",
+        "name": "C++ Mode",
+    },
+    "japanese": {
+        "prompt": "You are a Japanese assistant that can translate and write articles in Japanese. Regardless of what the user says, you will always respond in Japanese.",
+        "welcome": "Welcome to Japanese Translation and Writing Mode! You can ask me to translate Chinese into Japanese or write a Japanese article according to your needs!",
+        "name": "Chinese-Japanese Translation and Writing Mode",
+    },
+    "academic": {
+        "prompt": "You are an academic assistant that can proofread and write academic papers, with formal language and correct grammar.",
+        "welcome": "Welcome to Academic Writing Mode! You can ask me to write an academic paper according to your needs!",
+        "name": "Academic Writing Mode",
+    },
+    "custom": {
+        "prompt": None,
+        "welcome": "Please send me your customized system prompt in a specific format and I will respond to you according to your needs! For example: [SYSTEMPROMPT: You are a helpful assistant. Answer as concisely as possible!]",
+        "name": "Custom Mode",
+    },
+}
+
+
+def load_modes(config):
+    # command -> mode, commands are matched in lower case
+    modes = {command: dict(mode) for command, mode in default_modes.items()}
+    custom_modes = config.get("modes", {})
+    if not isinstance(custom_modes, dict):
+        raise ValueError('"modes" in config.json must be an object')
+    for command, mode in custom_modes.items():
+        if not isinstance(mode, dict):
+            raise ValueError(f'mode "{command}" in config.json must be an object')
+        command = command.lower().lstrip("/")
+        modes[command] = {"prompt": None, "welcome": "", "name": command, **modes.get(command, {}), **mode}
+    return modes
+
+
+def load_whitelist(ids):
+    # whitelist.json maps names to telegram user ids
+    if not isinstance(ids, dict):
+        raise ValueError("whitelist.json must be an object of names and user ids")
+    return frozenset(int(user_id) for user_id in ids.values())
+
+
+class Settings:
+    def __init__(self, directory=None, config_name="config.json", whitelist_name="whitelist.json"):
+        directory = directory or os.path.dirname(os.path.abspath(__file__))
+        self.config_path = os.path.join(directory, config_name)
+        self.whitelist_path = os.path.join(directory, whitelist_name)
+        # called with the settings after every reload
+        self.listeners = []
+        self.mtimes = None
+        # modification times of files that could not be loaded, reported once
+        self.broken_mtimes = None
+        # errors at start are raised, a broken file is only reported when reloading
+        self._apply(*self._read())
+
+    def _mtimes(self):
+        return tuple(os.stat(path).st_mtime_ns for path in (self.config_path, self.whitelist_path))
+
+    def _read(self):
+        # read and check both files before anything is replaced
+        mtimes = self._mtimes()
+        with open(self.config_path, "r") as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("config.json must be an object")
+        with open(self.whitelist_path, "r") as f:
+            whitelist = load_whitelist(json.load(f))
+        return mtimes, config, whitelist, load_modes(config)
+
+    def _apply(self, mtimes, config, whitelist, modes):
+        # replaced together without awaiting in between, handlers never see half of a reload
+        self.mtimes = mtimes
+        self.config = config
+        self.whitelist = whitelist
+        self.modes = modes
+
+    def reload(self):
+        # reload if a file changed, returns True if the settings were replaced
+        mtimes = None
+        try:
+            mtimes = self._mtimes()
+            if mtimes == self.mtimes or mtimes == self.broken_mtimes:
+                return False
+            loaded = self._read()
+        except Exception as e:
+            # e.g. a file that is being written or has the wrong shape, it is read again when it changes
+            if mtimes is None or mtimes != self.broken_mtimes:
+                logger.error("Settings not reloaded: {}".format(e))
+            self.broken_mtimes = mtimes
+            return False
+        self._apply(*loaded)
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                logger.error("Settings listener failed: {}".format(e))
+        return True
+
+    async def watch(self, interval=2.0):
+        # check the files every interval seconds, run it as a background task
+        while True:
+            await asyncio.sleep(interval)
+            if self.reload():
+                logger.info("Settings reloaded: {} users in the whitelist, {} modes".format(len(self.whitelist), len(self.modes)))
@@ -0,0 +1,74 @@
+import functools
+
+# tiktoken is optional, without it the number of tokens is estimated from the number of characters
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# context window of each model, in tokens
+context_windows = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+# used for models not listed above
+default_context_window = 4096
+
+# every message costs a few tokens on top of its content, and the reply is primed with a few more
+tokens_per_message = 4
+tokens_per_reply = 3
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # e.g. the encoding file cannot be downloaded, fall back to the estimation
+        return None
+
+
+def encoding_name(model):
+    # models with the same encoding (e.g. gpt-3.5-turbo and gpt-4-turbo) count the same tokens, counts are kept per encoding
+    encoding = _get_encoding(model)
+    return encoding.name if encoding is not None else "estimate"
+
+
+def count_tokens(text, model):
+    # not cached here, the count of each message is kept on conversation.Message so it goes away with the message
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # about 4 characters per token for english, non ascii characters usually take one token or more
+        ascii_chars = sum(1 for c in text if ord(c) < 128)
+        return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages, model):
+    return sum(count_tokens(m["content"], model) + tokens_per_message for m in messages) + tokens_per_reply
+
+
+def fit_messages(messages, model, budget):
+    # keep the newest messages (conversation.Message) that fit in budget tokens, the latest message is always kept
+    if len(messages) == 0:
+        return []
+    kept = [messages[-1]]
+    total = messages[-1].count_tokens(model) + tokens_per_message
+    for message in reversed(messages[:-1]):
+        total += message.count_tokens(model) + tokens_per_message
+        if total > budget:
+            break
+        kept.append(message)
+    kept.reverse()
+    # do not start the history with an answer without its question
+    while len(kept) > 1 and kept[0].role == "assistant":
+        kept.pop(0)
+    return kept
@@ -0,0 +1,65 @@
+import time
+import asyncio
+import metrics
+
+
+class UserQueueFull(Exception):
+    pass
+
+
+class UserQueue:
+    # messages of one user are handled one after another in the order they arrived,
+    # at most max_depth messages (including the running one) can wait per user
+    def __init__(self, max_depth=3):
+        self.max_depth = max_depth
+        self.users = {}
+
+    def depth(self, user_id):
+        state = self.users.get(user_id)
+        return state["waiting"] if state is not None else 0
+
+    async def run(self, user_id, job):
+        # run job() after the previous jobs of user_id, return its result, or None if it was cancelled by cancel()
+        state = self.users.get(user_id)
+        if state is None:
+            # asyncio.Lock wakes up waiters in FIFO order
+            state = {"lock": asyncio.Lock(), "waiting": 0, "task": None, "generation": 0}
+            self.users[user_id] = state
+        if state["waiting"] >= self.max_depth:
+            raise UserQueueFull(f"TOOMANY: {state['waiting']} messages are waiting")
+        state["waiting"] += 1
+        generation = state["generation"]
+        start = time.monotonic()
+        try:
+            async with state["lock"]:
+                metrics.queue_wait_seconds.observe(time.monotonic() - start)
+                if generation != state["generation"]:
+                    # cancelled while waiting
+                    return None
+                task = asyncio.create_task(job())
+                state["task"] = task
+                try:
+                    # wait does not raise if the job is cancelled, only if this coroutine is cancelled
+                    await asyncio.wait({task})
+                except asyncio.CancelledError:
+                    task.cancel()
+                    raise
+                finally:
+                    state["task"] = None
+                if task.cancelled():
+                    return None
+                return task.result()
+        finally:
+            state["waiting"] -= 1
+            if state["waiting"] == 0 and self.users.get(user_id) is state:
+                del self.users[user_id]
+
+    def cancel(self, user_id):
+        # cancel the running job and drop the waiting ones, returns True if something was cancelled
+        state = self.users.get(user_id)
+        if state is None:
+            return False
+        state["generation"] += 1
+        if state["task"] is not None:
+            state["task"].cancel()
+        return True
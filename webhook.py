@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import multiprocessing
+
+# webhook mode: this process receives updates from telegram and sends each of them to one of several worker processes.
+# all updates of a user go to the same worker, where they are handled in order by the user queue of app.py,
+# so conversations and per user rate limits can stay in the worker.
+# Use the sqlite conversation store and rate_limits.shared_path in config.json so that
+# conversations survive restarts and the openai budget is shared by all workers.
+# telegram only sends webhooks over https, run this behind a reverse proxy or load balancer that terminates tls.
+
+logger = logging.getLogger(__name__)
+
+
+def get_user_id(data):
+    # the user (or chat) that sent an update, updates without one are all handled by the first worker
+    for key, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            if isinstance(value.get(field), dict) and "id" in value[field]:
+                return value[field]["id"]
+    return 0
+
+
+def worker_main(index, queue):
+    # imported here so that only the workers create the bot, the openai client and the conversation store
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    from telegram import Update
+
+    async def run():
+        # every worker serves its own metrics, on the next ports
+        if app.metrics_port is not None:
+            app.metrics_port += index
+        application = app.build_application()
+        await application.initialize()
+        await app.post_init(application)
+        await application.start()
+        loop = asyncio.get_running_loop()
+        # updates are started in the order they arrived, app.user_queue keeps the messages of a user in this order
+        # while still letting "clear" cancel the answer in progress
+        tasks = set()
+
+        app.logger.info(f"Worker {index} started")
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            update = Update.de_json(data, application.bot)
+            task = asyncio.create_task(application.process_update(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # finish the updates that are still running
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await application.stop()
+        await app.post_shutdown(application)
+        await application.shutdown()
+
+    asyncio.run(run())
+
+
+class WebhookServer:
+    # minimal http server, telegram only sends POST requests with a json body
+    def __init__(self, queues, path, secret_token=None, max_body_size=1024 * 1024):
+        self.queues = queues
+        self.path = path
+        self.secret_token = secret_token
+        # the endpoint is public, larger bodies are refused before reading them
+        self.max_body_size = max_body_size
+
+    def dispatch(self, data):
+        user_id = get_user_id(data)
+        self.queues[hash(user_id) % len(self.queues)].put(data)
+
+    def check(self, method, path, headers):
+        # status of a request that is refused without reading its body, None if the body should be read
+        if method != "POST" or path != self.path:
+            return "404 Not Found"
+        if self.secret_token is not None and headers.get("x-telegram-bot-api-secret-token") != self.secret_token:
+            return "403 Forbidden"
+        length = headers.get("content-length", "")
+        if not length.isdigit():
+            return "400 Bad Request"
+        if int(length) > self.max_body_size:
+            return "413 Payload Too Large"
+        return None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                request_line = lines[0].split(" ")
+                status = self.check(request_line[0], request_line[1], headers) if len(request_line) >= 2 else "400 Bad Request"
+                if status is not None:
+                    # the body is not read, so the connection cannot be used for another request
+                    writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+                    await writer.drain()
+                    break
+
+                try:
+                    body = await reader.readexactly(int(headers["content-length"]))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                try:
+                    data = json.loads(body)
+                    if not isinstance(data, dict):
+                        raise ValueError("an update is a json object")
+                    self.dispatch(data)
+                    status = "200 OK"
+                except ValueError:
+                    status = "400 Bad Request"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n".encode())
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(config, queues):
+    from telegram import Bot
+
+    webhook = config.get("webhook", {})
+    path = webhook.get("path", "/telegram")
+    secret_token = webhook.get("secret_token")
+    server = WebhookServer(queues, path, secret_token, webhook.get("max_body_size", 1024 * 1024))
+    listener = await asyncio.start_server(server.handle, webhook.get("listen", "0.0.0.0"), webhook.get("port", 8080))
+
+    if "url" in webhook:
+        async with Bot(config["telegram_bot_token"]) as bot:
+            await bot.set_webhook(webhook["url"], secret_token=secret_token)
+    logger.info(f"Listening for webhooks on port {webhook.get('port', 8080)} with {len(queues)} workers")
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot in webhook mode with several worker processes")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, default: webhook.workers in config.json or the number of cpus")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(os.path.join(os.path.dirname(__file__), "config.json"), "r") as f:
+        config = json.load(f)
+    workers = args.workers or config.get("webhook", {}).get("workers") or os.cpu_count()
+    if workers > 1 and "shared_path" not in config.get("rate_limits", {}):
+        logger.warning("rate_limits.shared_path is not set, every worker will use the full openai budget")
+
+    # spawn instead of fork, the workers should not inherit the event loop of this process
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=worker_main, args=(index, queue), daemon=True) for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(serve(config, queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+
+
+if __name__ == "__main__":
+    main()